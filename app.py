@@ -1,11 +1,13 @@
 from flask import Flask, request, redirect, url_for, send_from_directory, jsonify
 import os
+import threading
 from reloadEmbeding import reloadEmbeding
 import cv2
 import numpy as np
 import base64
 import datetime
 from addFace import addFace
+from faceRecognise import recognise_frame
 import subprocess
 from MySQLConnector import getConnector
 from flask_cors import CORS
@@ -35,7 +37,6 @@ for folder in [INFO_UPLOAD_FOLDER, FACE_UPLOAD_FOLDER, NOTI_UPLOAD_FOLDER, AVATA
     if not os.path.exists(folder):
         os.makedirs(folder)
     
-reloadEmbeding()
 
 import sys
 import cv2
@@ -82,35 +83,20 @@ def process_face_recognition():
         # Lưu ảnh
         cv2.imwrite(filename, image)
 
-        # Gọi script nhận diện khuôn mặt
+        # Nhận diện trong process bằng mô hình và gallery thường trú
         try:
-            result = subprocess.run(
-                ['python', 'faceRecognise.py', filename], 
-                capture_output=True, 
-                text=True, 
-                timeout=30
-            )
-            
-            # Phân tích kết quả từ subprocess
-            if result.returncode == 0:
-                # Nếu thành công
+            success, message = recognise_frame(image, os.path.basename(filename))
+            if success:
                 return jsonify({
                     "status": "success", 
-                    "message": result.stdout.strip(),
+                    "message": message,
                     "file": filename
                 }), 200
             else:
-                # Nếu có lỗi
                 return jsonify({
                     "status": "error", 
-                    "message": result.stderr.strip()
+                    "message": message
                 }), 500
-
-        except subprocess.TimeoutExpired:
-            return jsonify({
-                "status": "error", 
-                "message": "Quá trình nhận diện mất quá nhiều thời gian"
-            }), 504
         except Exception as e:
             return jsonify({
                 "status": "error", 
@@ -485,4 +471,7 @@ def stoptall():
 #--------------------------------------------------------------
 # Chạy server Flask
 if __name__ == '__main__':
+    # Tạo lại embeddings ở nền để server nhận request ngay, không chờ xử lý hết ảnh.
+    # Chỉ chạy khi khởi động server: import app.py (kể cả process con spawn trên Windows) không rebuild.
+    threading.Thread(target=reloadEmbeding, name="reload-embeddings", daemon=True).start()
     app.run(host='0.0.0.0', port=8000, threaded=True)
@@ -23,5 +23,94 @@ class Config:
     'yunet': os.getenv("YUNET_ONXX", os.path.join(BASE_DIR, 'weights', 'face_detection_yunet_2023mar.onnx')),
     'sface': os.getenv("SFACE_ONXX", os.path.join(BASE_DIR, 'weights', 'face_recognition_sface_2021dec.onnx')),
     'embeddings': os.getenv("EMBEDDINGS", os.path.join(BASE_DIR, 'app', 'embeddings.pkl')),
+    'gallery': os.getenv("GALLERY", os.path.join(BASE_DIR, 'app', 'gallery')),
+    'embedding_cache': os.getenv("EMBEDDING_CACHE", os.path.join(BASE_DIR, 'app', 'embedding_cache.sqlite3')),
+  }
+  RECOGNITION = {
+    # Khoảng cách tối thiểu giữa ứng viên tốt nhất và ứng viên tốt nhì (người khác)
+    'min_margin': float(os.getenv("MATCH_MIN_MARGIN", 0.05)),
+    # Cách tìm kiếm gallery: 'exact' (toàn bộ), 'ivf' (xấp xỉ, cho gallery lớn)
+    # hoặc 'centroid' (centroid từng người rồi exemplar của shortlist)
+    'search': os.getenv("GALLERY_SEARCH", 'exact'),
+    'ivf_nlist': int(os.getenv("IVF_NLIST", 0)),  # 0: tự chọn ~sqrt(số embeddings)
+    'ivf_nprobe': int(os.getenv("IVF_NPROBE", 8)),
+    'template_exemplars': int(os.getenv("TEMPLATE_EXEMPLARS", 3)),
+    'template_shortlist': int(os.getenv("TEMPLATE_SHORTLIST", 5)),
+    # Số bộ YuNet + SFace dùng song song cho các request, 0: dùng số core CPU
+    'model_pool_size': int(os.getenv("MODEL_POOL_SIZE", 0)),
+    # Gom SFace của các request check-in đồng thời: tối đa bao nhiêu khuôn mặt
+    # và chờ tối đa bao nhiêu ms mỗi batch (batch_max_size <= 1 để tắt)
+    'batch_max_size': int(os.getenv("BATCH_MAX_SIZE", 16)),
+    'batch_max_wait_ms': float(os.getenv("BATCH_MAX_WAIT_MS", 5)),
+    # Thời gian chờ tối đa (giây) kết quả nhận diện một khuôn mặt, quá thì request trả về 503
+    'match_timeout': float(os.getenv("MATCH_TIMEOUT", 10)),
+    # Check-in bằng ảnh khuôn mặt 112x112 đã căn chỉnh từ kiosk: sai lệch tối đa (pixel)
+    # giữa 5 điểm mốc gửi lên và vị trí chuẩn của SFace
+    'crop_landmark_tolerance': float(os.getenv("CROP_LANDMARK_TOLERANCE", 6)),
+    # Chạy YuNet trên ảnh kiosk gửi lên và so 5 điểm mốc phát hiện được với điểm mốc gửi lên (0 để tắt)
+    'crop_verify_detection': int(os.getenv("CROP_VERIFY_DETECTION", 1)),
+    # Sai lệch tối đa (pixel) giữa điểm mốc YuNet tìm thấy trên ảnh đó và điểm mốc gửi lên
+    'crop_detection_tolerance': float(os.getenv("CROP_DETECTION_TOLERANCE", 8)),
+  }
+  GALLERY = {
+    # Số bản ghi trong log của gallery trước khi gộp vào file dữ liệu mới
+    'compact_threshold': int(os.getenv("GALLERY_COMPACT_THRESHOLD", 256)),
+    # Chu kỳ (giây) kiểm tra gallery thay đổi để camera worker tải lại
+    'reload_interval': float(os.getenv("GALLERY_RELOAD_INTERVAL", 2)),
+    # Số process khi tạo lại toàn bộ gallery, 0: dùng số core CPU
+    'rebuild_workers': int(os.getenv("GALLERY_REBUILD_WORKERS", 0)),
+  }
+  CAMERA = {
+    # Số khung hình mới nhất giữ trong ring buffer giữa thread đọc camera và vòng lặp xử lý
+    'buffer_size': int(os.getenv("CAMERA_BUFFER_SIZE", 2)),
+    # Chu kỳ (giây) ghi log bộ đếm khung hình (đọc được, đã xử lý, bị bỏ)
+    'stats_interval': float(os.getenv("CAMERA_STATS_INTERVAL", 60)),
+    # Các stage của camera worker chạy trong 'thread' hoặc 'process' riêng
+    'pipeline_mode': os.getenv("CAMERA_PIPELINE_MODE", 'thread'),
+    # Số packet tối đa chờ giữa hai stage liên tiếp
+    'queue_size': int(os.getenv("CAMERA_QUEUE_SIZE", 2)),
+    # Hiển thị cửa sổ OpenCV với khung hình đã vẽ (tắt khi chạy trên server không màn hình)
+    'show_window': os.getenv("CAMERA_SHOW_WINDOW", '1') == '1',
+    # Chạy tất cả camera trong một process chung (camera_host) thay vì mỗi camera một process
+    'worker_host': os.getenv("CAMERA_WORKER_HOST", '0') == '1',
+    # Số thread suy luận dùng chung cho mọi camera trong camera_host (0 = số CPU)
+    'inference_threads': int(os.getenv("CAMERA_INFERENCE_THREADS", 0)),
+    # Cổng ZeroMQ (127.0.0.1) nhận lệnh start/stop/status của camera_host
+    'host_control_port': int(os.getenv("CAMERA_HOST_PORT", 7999)),
+    # Ghi khung hình thô vào shared memory cho các process cùng máy (FrameRingReader)
+    'shared_frames': os.getenv("CAMERA_SHARED_FRAMES", '1') == '1',
+    # Số slot của ring buffer shared memory mỗi camera
+    'ring_slots': int(os.getenv("CAMERA_RING_SLOTS", 4)),
+    # Cổng thông báo slot mới của camera = ring_port_base + camera_id (chỉ 127.0.0.1)
+    'ring_port_base': int(os.getenv("CAMERA_RING_PORT_BASE", 9000)),
+    # Mã hoá JPEG và gửi qua ZeroMQ PUB cổng 8000 + camera_id cho người xem từ máy khác
+    'remote_stream': os.getenv("CAMERA_REMOTE_STREAM", '1') == '1',
+    # Các mức chất lượng gửi cho người xem, dạng topic:tỉ_lệ_kích_thước:chất_lượng_jpeg:fps_tối_đa (0 = không giới hạn).
+    # Mỗi topic chỉ được mã hoá khi có subscriber; 'newframe' là topic cũ, độ phân giải gốc
+    'stream_tiers': os.getenv("CAMERA_STREAM_TIERS", 'newframe:1.0:80:15,medium:0.5:70:10,low:0.25:50:5'),
+    # Máy chạy camera worker mà gateway xem trực tiếp (MJPEG/WebSocket) subscribe tới
+    'stream_upstream_host': os.getenv("CAMERA_STREAM_HOST", '127.0.0.1'),
+    # Đóng stream MJPEG nếu camera không gửi khung hình nào trong chừng này giây
+    'stream_idle_timeout': float(os.getenv("CAMERA_STREAM_IDLE_TIMEOUT", 30)),
+    # Cổng server WebSocket xem camera trực tiếp (0 = tắt)
+    'ws_port': int(os.getenv("CAMERA_WS_PORT", 8765)),
+    # Chạy YuNet tối thiểu mỗi detect_interval khung hình (0 = không theo số khung hình) ...
+    'detect_interval': int(os.getenv("CAMERA_DETECT_INTERVAL", 10)),
+    # ... hoặc mỗi detect_max_age giây (0 = không theo thời gian); giữa hai lần dùng tracker KCF
+    'detect_max_age': float(os.getenv("CAMERA_DETECT_MAX_AGE", 1.0)),
+    # Tỉ lệ pixel chuyển động (ngoài khuôn mặt đang theo dõi) buộc phát hiện lại ngay
+    'detect_motion_threshold': float(os.getenv("CAMERA_DETECT_MOTION", 0.01)),
+    # Chiều rộng ảnh xám thu nhỏ dùng để đo chuyển động
+    'motion_width': int(os.getenv("CAMERA_MOTION_WIDTH", 96)),
+    # Độ chênh mức xám tối thiểu để tính một pixel là thay đổi
+    'motion_pixel_delta': int(os.getenv("CAMERA_MOTION_PIXEL_DELTA", 20)),
+    # Bỏ qua phát hiện/nhận diện khi camera không có chuyển động
+    'motion_gate': os.getenv("CAMERA_MOTION_GATE", '1') == '1',
+    # Vùng đo chuyển động x0,y0,x1,y1 theo tỉ lệ khung hình; riêng từng camera: 'id:x0,y0,x1,y1;...'
+    'motion_region': os.getenv("CAMERA_MOTION_REGION", '0,0,1,1'),
+    'motion_regions': os.getenv("CAMERA_MOTION_REGIONS", ''),
+    # Tỉ lệ pixel thay đổi trong vùng để mở cổng chuyển động
+    'motion_gate_threshold': float(os.getenv("CAMERA_MOTION_GATE_THRESHOLD", 0.002)),
+    # Số giây giữ xử lý đầy đủ sau chuyển động cuối cùng
+    'motion_hold': float(os.getenv("CAMERA_MOTION_HOLD", 5)),
   }
-  
\ No newline at end of file
@@ -1,5 +1,6 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response, current_app
 from app.services.camera_services import start, check, stop
+from app.services.stream_gateway import gateway, mjpeg_frames, stream_topics, authorize_token, MJPEG_BOUNDARY
 from app.middleware.auth import require_permission, require_resource_access, admin_required
 from app.config import Config
 import mysql.connector
@@ -38,6 +39,40 @@ def check_camera_status(id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@camera_bp.route('/stream/<int:camera_id>', methods=['GET'])
+def stream_camera(camera_id):
+    """
+    Xem trực tiếp camera dạng MJPEG, ?quality=<topic> (mặc định newframe).
+    Thẻ <img> không gửi được header Authorization nên access token nhận qua ?token=<access token>
+    hoặc header Authorization: Bearer như các route khác; cần quyền security.view.
+    """
+    token = request.args.get('token')
+    if not token:
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header[len('Bearer '):] if auth_header.startswith('Bearer ') else None
+    if not token:
+        return jsonify({"error": "Missing access token"}), 401
+    if not authorize_token(current_app._get_current_object(), token, 'security.view'):
+        return jsonify({"error": "Access denied. Required permission: security.view"}), 403
+
+    quality = request.args.get('quality', 'newframe')
+    if quality not in stream_topics():
+        return jsonify({"error": f"Invalid quality. Must be one of: {', '.join(stream_topics())}"}), 400
+    return Response(
+        mjpeg_frames(camera_id, quality),
+        mimetype=f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}',
+        headers={'Cache-Control': 'no-cache'}
+    )
+
+@camera_bp.route('/stream-gateway', methods=['GET'])
+@require_permission('security.view')
+def get_stream_gateway_status():
+    """Trạng thái gateway xem trực tiếp: số khung hình nhận, gửi và bỏ của từng client"""
+    try:
+        return jsonify(gateway.stats()), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @camera_bp.route('/list', methods=['GET'])
 @require_permission('security.view')
 def get_camera_list():
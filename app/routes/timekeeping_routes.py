@@ -3,12 +3,10 @@ from app.services.timekeeping_services import checkin_logic, checkout_logic, get
 from app.middleware.auth import require_permission, require_any_permission, login_required, has_permission
 import mysql.connector
 from app.config import Config
-import os
 from werkzeug.utils import secure_filename
 import base64
-from io import BytesIO
-from PIL import Image
-import datetime
+import json
+from app.utils.image_io import decode_image, evidence_filename, save_image_async
 
 timekeeping_bp = Blueprint('timekeeping', __name__)
 
@@ -85,34 +83,71 @@ def realtime():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
       
+def _read_image_upload():
+    """
+    Đọc bytes ảnh check-in/check-out từ request, hỗ trợ:
+        - body nhị phân (Content-Type: image/jpeg, image/png hoặc application/octet-stream),
+        - multipart/form-data với trường file 'file',
+        - JSON {"file": "<base64>"} như trước.
+    Chế độ ảnh kiosk: nếu kèm 5 điểm mốc (JSON/form 'landmarks' hoặc header X-Face-Landmarks,
+    dạng [[x, y], ...]) thì ảnh là khuôn mặt 112x112 đã căn chỉnh và server bỏ qua bước phát hiện.
+    Returns:
+        tuple: (bytes ảnh hoặc None nếu request không có ảnh, landmarks hoặc None)
+    Raises:
+        ValueError: landmarks không phải JSON hợp lệ.
+    """
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        return request.get_data(cache=False), _parse_landmarks(request.headers.get('X-Face-Landmarks'))
+
+    if request.mimetype == 'multipart/form-data':
+        file = request.files.get('file')
+        return (file.read() if file else None), _parse_landmarks(request.form.get('landmarks'))
+
+    data = request.get_json(silent=True)
+    if not data or 'file' not in data:
+        return None, None
+    base64_image = data['file']
+    if ',' in base64_image:
+        base64_image = base64_image.split(',')[1]
+    return base64.b64decode(base64_image), data.get('landmarks')
+
+def _parse_landmarks(value):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        raise ValueError("Invalid landmarks JSON")
+
 @timekeeping_bp.route('/checkin', methods=['POST'])
 @login_required  # Chỉ cần đăng nhập, không cần quyền đặc biệt
 def checkin():
     try:
-        data = request.get_json()
-        if not data or 'file' not in data:
-            return jsonify({"error": "Missing base64 image data"}), 400
-
-        base64_image = data['file']
-        if ',' in base64_image:
-            base64_image = base64_image.split(',')[1]
+        try:
+            image_data, landmarks = _read_image_upload()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if not image_data:
+            return jsonify({"error": "Missing image data"}), 400
 
-        image_data = base64.b64decode(base64_image)
-        image = Image.open(BytesIO(image_data))
+        frame = decode_image(image_data)
+        if frame is None:
+            return jsonify({"error": "Invalid image data"}), 400
 
-        save_dir = Config.PATHS['timekeepings']
-        os.makedirs(save_dir, exist_ok=True)
-        filename = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-        save_path = os.path.join(save_dir, filename)
-        image.save(save_path)
+        # Ảnh bằng chứng được ghi nguyên bytes ở nền, nhận diện chạy trên ảnh trong bộ nhớ
+        filename = evidence_filename(image_data)
+        save_image_async(image_data, Config.PATHS['timekeepings'], filename)
 
         # Gọi service để check-in
-        result = checkin_logic(filename)
+        result = checkin_logic(filename, frame, landmarks)
 
         if isinstance(result, dict) and result.get("status") == "error":
             return jsonify(result), 400
         return jsonify(result), 200
 
+    except TimeoutError as e:
+        # Hàng đợi nhận diện quá tải, client có thể thử lại
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
       
@@ -120,30 +155,31 @@ def checkin():
 @login_required  # Chỉ cần đăng nhập, không cần quyền đặc biệt
 def checkout():
     try:
-        data = request.get_json()
-        if not data or 'file' not in data:
-            return jsonify({"error": "Missing base64 image data"}), 400
-
-        base64_image = data['file']
-        if ',' in base64_image:
-            base64_image = base64_image.split(',')[1]
+        try:
+            image_data, landmarks = _read_image_upload()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if not image_data:
+            return jsonify({"error": "Missing image data"}), 400
 
-        image_data = base64.b64decode(base64_image)
-        image = Image.open(BytesIO(image_data))
+        frame = decode_image(image_data)
+        if frame is None:
+            return jsonify({"error": "Invalid image data"}), 400
 
-        save_dir = Config.PATHS['timekeepings']
-        os.makedirs(save_dir, exist_ok=True)
-        filename = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-        save_path = os.path.join(save_dir, filename)
-        image.save(save_path)
+        # Ảnh bằng chứng được ghi nguyên bytes ở nền, nhận diện chạy trên ảnh trong bộ nhớ
+        filename = evidence_filename(image_data)
+        save_image_async(image_data, Config.PATHS['timekeepings'], filename)
 
         # Gọi service để check-out
-        result = checkout_logic(filename)
+        result = checkout_logic(filename, frame, landmarks)
 
         if isinstance(result, dict) and result.get("status") == "error":
             return jsonify(result), 400
         return jsonify(result), 200
 
+    except TimeoutError as e:
+        # Hàng đợi nhận diện quá tải, client có thể thử lại
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1,15 +1,57 @@
 import subprocess
+import threading
 import os
+import zmq
+from app.config import Config
 
 dict_processes = {}
 
 path = os.path.join('app', 'utils', 'AI_process.py')
 
+# Chế độ camera_host: mọi camera chạy trong một process chung, điều khiển qua ZeroMQ REQ/REP
+host_process = None
+host_lock = threading.Lock()
+host_socket = None
+HOST_TIMEOUT_MS = 10000
+
+def _ensure_host():
+  global host_process
+  if host_process is None or host_process.poll() is not None:
+    host_process = subprocess.Popen(['python', '-m', 'app.utils.camera_host'])
+
+def _host_request(message):
+  """Gửi một lệnh tới camera_host và chờ trả lời (tạo lại socket nếu hết thời gian chờ)."""
+  global host_socket
+  with host_lock:
+    _ensure_host()
+    if host_socket is None:
+      host_socket = zmq.Context.instance().socket(zmq.REQ)
+      host_socket.setsockopt(zmq.RCVTIMEO, HOST_TIMEOUT_MS)
+      host_socket.setsockopt(zmq.LINGER, 0)
+      host_socket.connect(f"tcp://127.0.0.1:{Config.CAMERA['host_control_port']}")
+    try:
+      host_socket.send_json(message)
+      reply = host_socket.recv_json()
+    except zmq.Again:
+      host_socket.close()
+      host_socket = None
+      raise TimeoutError("Camera host không phản hồi")
+  if reply.get('status') != 'success':
+    raise RuntimeError(reply.get('message'))
+  return reply
+
 def start(id):
+  if Config.CAMERA['worker_host']:
+    _host_request({'cmd': 'start', 'id': int(id)})
+    return
   process = subprocess.Popen(['python', path, str(id)])
   dict_processes[id] = process
-  
+
 def check(id):
+  if Config.CAMERA['worker_host']:
+    if host_process is None or host_process.poll() is not None:
+      return False
+    return str(int(id)) in _host_request({'cmd': 'status'})['cameras']
   if id in dict_processes:
     status = dict_processes[id].poll()
     if status is None:
@@ -21,8 +63,12 @@ def check(id):
   else:
     print("Không tồn tại tiến trình: ", id)
     return False
-  
+
 def stop(id):
+  if Config.CAMERA['worker_host']:
+    if _host_request({'cmd': 'stop', 'id': int(id)})['stopped']:
+      return f"Đã kết thúc camera {id}",200
+    return f"Camera {id} không chạy",200
   if int(id) in dict_processes:
         dict_processes[int(id)].terminate()
         return f"Đã kết thúc tiến trình {id}",200
@@ -31,4 +77,4 @@ def stop(id):
         return f"Đã kết thúc tiến trình {id}",200
   else:
         return f"Tiến trình {id} không tồn tại",200
-    
\ No newline at end of file
+
@@ -0,0 +1,236 @@
+import time
+import logging
+import threading
+from urllib.parse import urlparse, parse_qs
+import zmq
+from flask_jwt_extended import decode_token
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.server import serve
+from app.config import Config
+from app.middleware.auth import get_user_info, get_user_permissions
+from app.utils.frame_publisher import parse_tiers
+
+logger = logging.getLogger(__name__)
+
+MJPEG_BOUNDARY = 'frame'
+
+
+class Viewer:
+    """
+    Một client đang xem: chỉ giữ khung hình mới nhất chưa gửi. Client chậm thì khung hình cũ
+    bị thay bằng khung hình mới (đếm trong dropped) thay vì dồn lại trong bộ nhớ.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._frame = None
+        self._condition = threading.Condition()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+
+    def offer(self, frame):
+        with self._condition:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self._condition.notify()
+
+    def next(self, timeout=None):
+        """Lấy khung hình JPEG mới nhất, hoặc None nếu hết thời gian chờ hay stream đã đóng."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._frame is not None or self.closed, timeout)
+            frame, self._frame = self._frame, None
+        if frame is not None:
+            self.sent += 1
+        return frame
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class CameraStream:
+    """
+    Một subscription ZeroMQ tới worker của camera (cổng 8000 + camera_id, một topic chất lượng),
+    dùng chung cho mọi client đang xem camera đó. Thread nhận dừng khi client cuối cùng rời đi,
+    nên worker cũng ngừng mã hoá topic này.
+    """
+
+    def __init__(self, camera_id, topic):
+        self.camera_id = camera_id
+        self.topic = topic
+        self.viewers = set()
+        self.received = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'stream-{camera_id}-{topic}', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.RCVHWM, 2)
+        socket.setsockopt_string(zmq.SUBSCRIBE, self.topic)
+        socket.connect(f"tcp://{Config.CAMERA['stream_upstream_host']}:{8000 + int(self.camera_id)}")
+        logger.info(f"Stream gateway subscribed to camera {self.camera_id} topic '{self.topic}'")
+        while not self._stopped.is_set():
+            try:
+                if not socket.poll(1000):
+                    continue
+                topic, frame = socket.recv_multipart()
+            except (zmq.ZMQError, ValueError) as e:
+                logger.error(f"Error receiving stream of camera {self.camera_id}: {e}")
+                time.sleep(1)
+                continue
+            # SUBSCRIBE so khớp theo prefix, chỉ nhận đúng topic đã chọn
+            if topic.decode(errors='replace') != self.topic:
+                continue
+            self.received += 1
+            for viewer in list(self.viewers):
+                viewer.offer(frame)
+        socket.close(linger=0)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class StreamGateway:
+    """Quản lý các CameraStream: mỗi (camera, topic) một subscription dù có bao nhiêu client."""
+
+    def __init__(self):
+        self.streams = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, camera_id, topic='newframe'):
+        key = (int(camera_id), topic)
+        with self._lock:
+            stream = self.streams.get(key)
+            if stream is None:
+                stream = self.streams[key] = CameraStream(int(camera_id), topic)
+            viewer = Viewer(stream)
+            stream.viewers.add(viewer)
+        return viewer
+
+    def unsubscribe(self, viewer):
+        stream = viewer.stream
+        viewer.close()
+        with self._lock:
+            stream.viewers.discard(viewer)
+            if not stream.viewers:
+                stream.stop()
+                self.streams.pop((stream.camera_id, stream.topic), None)
+        logger.info(f"Viewer left camera {stream.camera_id}: sent {viewer.sent}, dropped {viewer.dropped}")
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    'camera_id': stream.camera_id,
+                    'topic': stream.topic,
+                    'received': stream.received,
+                    'viewers': [{'sent': v.sent, 'dropped': v.dropped} for v in stream.viewers],
+                }
+                for stream in self.streams.values()
+            ]
+
+
+gateway = StreamGateway()
+
+
+def stream_topics():
+    """Các topic chất lượng mà camera worker gửi (Config.CAMERA['stream_tiers'])."""
+    return list(parse_tiers(Config.CAMERA['stream_tiers']))
+
+
+def mjpeg_frames(camera_id, topic='newframe'):
+    """
+    Generator cho response multipart/x-mixed-replace. Kết thúc khi camera không gửi khung hình nào
+    trong stream_idle_timeout giây hoặc client ngắt kết nối.
+    """
+    viewer = gateway.subscribe(camera_id, topic)
+    idle_timeout = Config.CAMERA['stream_idle_timeout']
+    last_frame = time.monotonic()
+    try:
+        while not viewer.closed and time.monotonic() - last_frame < idle_timeout:
+            frame = viewer.next(timeout=1)
+            if frame is None:
+                continue
+            last_frame = time.monotonic()
+            yield (f"--{MJPEG_BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                   f"Content-Length: {len(frame)}\r\n\r\n").encode() + frame + b"\r\n"
+    finally:
+        gateway.unsubscribe(viewer)
+
+
+def authorize_token(app, token, permission):
+    """
+    Kiểm tra access token (JWT) có thuộc user đang hoạt động và có quyền permission.
+    Dùng cho các kết nối không gửi được header Authorization: WebSocket, thẻ <img> của MJPEG.
+    decode_token không xét blocklist nên tự loại refresh token và token đã bị thu hồi bởi /logout.
+    """
+    if not token:
+        return False
+    try:
+        with app.app_context():
+            decoded = decode_token(token)
+    except Exception:
+        return False
+    if decoded.get('type') != 'access' or decoded.get('jti') in app.blacklisted_tokens:
+        return False
+    user_id = decoded['sub']
+    return get_user_info(user_id) is not None and permission in get_user_permissions(user_id)
+
+
+def _websocket_handler(app, websocket):
+    """
+    ws://host:ws_port/camera/<id>?quality=<topic>&token=<access token>
+    Mỗi khung hình JPEG là một message nhị phân; client chậm bị bỏ khung hình chứ không bị dồn.
+    """
+    url = urlparse(websocket.request.path)
+    query = parse_qs(url.query)
+    parts = url.path.strip('/').split('/')
+    if len(parts) != 2 or parts[0] != 'camera' or not parts[1].isdigit():
+        websocket.close(1008, 'Unknown stream')
+        return
+    if not authorize_token(app, query.get('token', [None])[0], 'security.view'):
+        websocket.close(1008, 'Access denied')
+        return
+    topic = query.get('quality', ['newframe'])[0]
+    if topic not in stream_topics():
+        websocket.close(1008, 'Unknown quality')
+        return
+
+    viewer = gateway.subscribe(parts[1], topic)
+    try:
+        while not viewer.closed:
+            frame = viewer.next(timeout=5)
+            if frame is None:
+                # Không có khung hình: ping để phát hiện client đã ngắt kết nối
+                websocket.ping()
+                continue
+            websocket.send(frame)
+    except ConnectionClosed:
+        pass
+    finally:
+        gateway.unsubscribe(viewer)
+
+
+_websocket_server = None
+
+
+def start_websocket_server(app):
+    """
+    Chạy server WebSocket (thư viện websockets, API đồng bộ) trong thread nền, cổng Config.CAMERA['ws_port'].
+    Chỉ gọi từ entry point của process phục vụ request (run.py), không gọi khi import hay trong create_app.
+    """
+    global _websocket_server
+    port = Config.CAMERA['ws_port']
+    if not port or _websocket_server is not None:
+        return
+    try:
+        _websocket_server = serve(lambda websocket: _websocket_handler(app, websocket), '0.0.0.0', port)
+    except OSError as e:
+        logger.warning(f"Camera WebSocket server not started on port {port}: {e}")
+        return
+    threading.Thread(target=_websocket_server.serve_forever, name='camera-websocket', daemon=True).start()
+    logger.info(f"Camera WebSocket server listening on port {port}")
@@ -2,7 +2,7 @@ import mysql.connector
 from mysql.connector import Error
 from app.config import Config
 from datetime import datetime
-from app.utils.recognise import match_face_embedding
+from app.utils.recognise import match_face_embedding, match_face_frame, match_aligned_crop, validate_aligned_crop
 
 
 def get_all():
@@ -100,15 +100,42 @@ def get_realtime_attendance():
         if connection and connection.is_connected():
             connection.close()
 
-def checkin_logic(file_name):
+def _recognise(file_name, frame=None, landmarks=None):
     """
-    1. Nhận tham số file_name (tên file hoặc đường dẫn file ảnh).
-    2. Gọi match_face_embedding(file_name) để lấy (confidence, personcode).
+    Nhận diện ảnh chấm công:
+        - có landmarks: frame là khuôn mặt 112x112 kiosk đã căn chỉnh, bỏ qua bước phát hiện,
+        - có frame: ảnh đầy đủ đã giải mã trong bộ nhớ,
+        - còn lại: đọc file file_name trong Config.PATHS['timekeepings'].
+    """
+    if landmarks is not None:
+        # Ảnh đã được kiểm tra ở _invalid_crop
+        return match_aligned_crop(frame, landmarks, source=file_name, validate=False)
+    if frame is not None:
+        return match_face_frame(frame, source=file_name)
+    return match_face_embedding(file_name)
+
+def _invalid_crop(frame, landmarks):
+    """Lỗi trả về client nếu ảnh kiosk (có landmarks) không phải khuôn mặt đã căn chỉnh hợp lệ, ngược lại None."""
+    if landmarks is None:
+        return None
+    reason = validate_aligned_crop(frame, landmarks)
+    if reason:
+        return {"status": "error", "message": f"Ảnh khuôn mặt không hợp lệ: {reason}"}
+    return None
+
+def checkin_logic(file_name, frame=None, landmarks=None):
+    """
+    1. Nhận tham số file_name (tên file hoặc đường dẫn file ảnh), frame (ảnh đã giải mã, nếu có)
+       và landmarks (5 điểm mốc nếu frame là khuôn mặt kiosk đã căn chỉnh).
+    2. Gọi _recognise để lấy (confidence, personcode).
     3. Truy vấn bảng Employee để lấy employee_id từ personcode.
     4. Gọi stored procedure sp_check_in(employee_id, photo_url).
     """
     # 1. Nhận kết quả nhận diện gương mặt
-    result = match_face_embedding(file_name)
+    error = _invalid_crop(frame, landmarks)
+    if error:
+        return error
+    result = _recognise(file_name, frame, landmarks)
     if not result or len(result) < 2:
         return {"status": "error", "message": "Không xác định được personcode từ ảnh"}
     person_id = result[0]
@@ -142,11 +169,14 @@ def checkin_logic(file_name):
         if connection and connection.is_connected():
             connection.close()
             
-def checkout_logic(file_name):
+def checkout_logic(file_name, frame=None, landmarks=None):
     """
     Tương tự checkin_logic, nhưng gọi sp_check_out(employee_id, photo_url).
     """
-    result = match_face_embedding(file_name)
+    error = _invalid_crop(frame, landmarks)
+    if error:
+        return error
+    result = _recognise(file_name, frame, landmarks)
     if not result or len(result) < 2:
         return {"status": "error", "message": "Không xác định được personcode từ ảnh"}
     person_id = result[0]
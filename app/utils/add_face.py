@@ -1,11 +1,13 @@
 import cv2
 import numpy as np
 import os
-import pickle
 import logging
 from flask import Blueprint, request, jsonify
 from werkzeug.utils import secure_filename
 from app.config import Config
+from app.utils.gallery_store import append_entry
+from app.utils.embedding_cache import EmbeddingCache, file_hash
+from app.utils.face_service import get_face_service, notify_gallery_changed
 from MySQLConnector import getConnector
 
 # Thiết lập logging
@@ -22,13 +24,12 @@ logger = logging.getLogger(__name__)
 # Khởi tạo Blueprint
 person_bp = Blueprint('person', __name__)
 
-# Khởi tạo mô hình nhận diện khuôn mặt
+# Mô hình nhận diện lấy từ pool của FaceService (get_face_service), không dùng chung một instance
 try:
-    face_detector = cv2.FaceDetectorYN.create(Config.PATHS['yunet'], "", (640, 480))
-    sface_model = cv2.FaceRecognizerSF.create(Config.PATHS['sface'], "")
-    logger.info("Initialized face detector and recognizer models")
+    embedding_cache = EmbeddingCache.open_default()
+    logger.info("Opened embedding cache")
 except Exception as e:
-    logger.error(f"Failed to initialize face detector or recognizer: {str(e)}")
+    logger.error(f"Failed to open embedding cache: {str(e)}")
     raise
 
 def resize_if_needed(image, max_width=1280, max_height=720):
@@ -46,9 +47,65 @@ def resize_if_needed(image, max_width=1280, max_height=720):
         logger.error(f"Error resizing image: {str(e)}")
         raise
 
+def extract_face_features(image_path):
+    """
+    Trích xuất đặc trưng SFace của mọi khuôn mặt trong ảnh, tra cache embedding theo nội dung ảnh trước.
+    Args:
+        image_path (str): Đường dẫn ảnh.
+    Returns:
+        ndarray: Đặc trưng (n, 128), n = 0 nếu không có khuôn mặt; None nếu có lỗi.
+    """
+    try:
+        image_hash = file_hash(image_path)
+        features = embedding_cache.get(image_hash)
+        if features is not None:
+            logger.info(f"Loaded {len(features)} face feature(s) for {image_path} from embedding cache")
+            return features
+    except Exception as e:
+        logger.warning(f"Embedding cache lookup failed for {image_path}: {str(e)}")
+        image_hash = None
+
+    # Đọc ảnh
+    try:
+        frame = cv2.imread(image_path)
+        if frame is None:
+            logger.error(f"Failed to read image: {image_path}")
+            return None
+    except Exception as e:
+        logger.error(f"Error reading image {image_path}: {str(e)}")
+        return None
+
+    # Resize ảnh nếu cần
+    try:
+        resized = resize_if_needed(frame)
+    except Exception as e:
+        logger.error(f"Error resizing image {image_path}: {str(e)}")
+        return None
+
+    # Mượn một bộ mô hình trong pool cho cả bước phát hiện và trích xuất đặc trưng
+    try:
+        with get_face_service().pool.checkout() as models:
+            faces = models.detect(resized)
+            features = np.array(
+                [models.embed(resized, face).ravel() for face in faces],
+                dtype=np.float32
+            ).reshape(-1, 128)
+        logger.info(f"Extracted {len(features)} face feature(s) for {image_path}")
+    except Exception as e:
+        logger.error(f"Error extracting face feature for {image_path}: {str(e)}")
+        return None
+
+    # Cache lưu đặc trưng trên ảnh gốc (giống rebuild_gallery), nên bỏ qua ảnh đã bị resize
+    if image_hash is not None and resized is frame:
+        try:
+            embedding_cache.put(image_hash, features)
+        except Exception as e:
+            logger.warning(f"Cannot store embeddings for {image_path} in cache: {str(e)}")
+    return features
+
 def add_face(file, person_id, person_code):
     """
-    Thêm một khuôn mặt mới vào file embeddings.pkl, lưu ảnh vào Config.PATHS['faces'],
+    Thêm một khuôn mặt mới vào gallery Config.PATHS['gallery'], lưu ảnh vào Config.PATHS['faces'],
     và insert bản ghi vào bảng image.
     Args:
         file (FileStorage): Đối tượng file từ request.files.
@@ -92,102 +149,26 @@ def add_face(file, person_id, person_code):
         logger.error(f"Error saving temporary file {file.filename}: {str(e)}")
         return False
 
-    # Đọc ảnh
-    try:
-        frame = cv2.imread(temp_path)
-        if frame is None:
-            logger.error(f"Failed to read image: {temp_path}")
-            return False
-    except Exception as e:
-        logger.error(f"Error reading image {temp_path}: {str(e)}")
+    # Trích xuất đặc trưng, dùng cache embedding nếu ảnh này đã từng được xử lý
+    features = extract_face_features(temp_path)
+    if features is None:
         return False
-
-    # Resize ảnh nếu cần
-    try:
-        frame = resize_if_needed(frame)
-    except Exception as e:
-        logger.error(f"Error resizing image {temp_path}: {str(e)}")
+    if len(features) == 0:
+        logger.warning(f"No faces detected in image: {file.filename}")
         return False
-
-    # Thiết lập kích thước đầu vào cho face_detector
-    try:
-        h, w = frame.shape[:2]
-        face_detector.setInputSize((w, h))
-        logger.info(f"Set input size for face detector: {w}x{h}")
-    except Exception as e:
-        logger.error(f"Error setting input size for face detector: {str(e)}")
-        return False
-
-    # Phát hiện khuôn mặt
-    try:
-        faces = face_detector.detect(frame)
-        if faces[1] is None or len(faces[1]) == 0:
-            logger.warning(f"No faces detected in image: {file.filename}")
-            return False
-        if len(faces[1]) > 1:
-            logger.warning(f"Multiple faces detected in image: {file.filename}. Only one face is allowed.")
-            return False
-    except Exception as e:
-        logger.error(f"Error detecting faces in {file.filename}: {str(e)}")
-        return False
-
-    # Trích xuất đặc trưng khuôn mặt
-    try:
-        face = faces[1][0]  # Lấy khuôn mặt đầu tiên
-        aligned_face = sface_model.alignCrop(frame, face)
-        feature = sface_model.feature(aligned_face)
-        logger.info(f"Extracted face feature for {file.filename}")
-    except Exception as e:
-        logger.error(f"Error extracting face feature for {file.filename}: {str(e)}")
-        return False
-
-    # Đọc file embeddings.pkl hiện tại (nếu có)
-    output_file = Config.PATHS['embeddings']
-    person_ids = []
-    person_codes = []
-    embeddings = []
-
-    if os.path.exists(output_file):
-        if os.path.getsize(output_file) == 0:
-            logger.warning(f"Embeddings file {output_file} is empty. Initializing empty lists.")
-        else:
-            try:
-                with open(output_file, 'rb') as f:
-                    data = pickle.load(f)
-                    if not isinstance(data, tuple) or len(data) != 3:
-                        logger.error(f"Invalid data format in {output_file}. Initializing empty lists.")
-                    else:
-                        person_ids, show_person_ids, embeddings = data
-                        if not (isinstance(person_ids, list) and isinstance(show_person_ids, list) and isinstance(embeddings, list)):
-                            logger.error(f"Invalid data types in {output_file}. Initializing empty lists.")
-                            person_ids = []
-                            show_person_ids = []
-                            embeddings = []
-                        else:
-                            logger.info(f"Loaded existing embeddings from {output_file}: {len(person_ids)} entries")
-            except Exception as e:
-                logger.error(f"Error reading embeddings file {output_file}: {str(e)}")
-                logger.warning("Initializing empty lists due to read error.")
-    else:
-        logger.info(f"Embeddings file {output_file} does not exist. Initializing empty lists.")
-
-    # Thêm đặc trưng mới
-    try:
-        person_ids.append(person_id)
-        person_codes.append(person_code)
-        embeddings.append(feature)
-        logger.info(f"Added new embedding for person_id: {person_id}, person_code: {person_code}")
-    except Exception as e:
-        logger.error(f"Error adding new embedding: {str(e)}")
+    if len(features) > 1:
+        logger.warning(f"Multiple faces detected in image: {file.filename}. Only one face is allowed.")
         return False
+    feature = features[:1]
 
-    # Lưu lại file embeddings.pkl
+    # Thêm đặc trưng mới vào gallery
+    gallery_dir = Config.PATHS['gallery']
     try:
-        with open(output_file, 'wb') as f:
-            pickle.dump((person_ids, person_codes, embeddings), f)
-        logger.info(f"Saved embeddings to {output_file} for person_id: {person_id}, person_code: {person_code}")
+        append_entry(gallery_dir, person_id, person_code, feature)
+        notify_gallery_changed()
+        logger.info(f"Added new embedding to {gallery_dir} for person_id: {person_id}, person_code: {person_code}")
     except Exception as e:
-        logger.error(f"Error saving embeddings file {output_file}: {str(e)}")
+        logger.error(f"Error adding embedding to gallery {gallery_dir}: {str(e)}")
         return False
 
     # Lưu ảnh vào Config.PATHS['faces']
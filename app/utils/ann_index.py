@@ -0,0 +1,203 @@
+import sys
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+class IVFIndex:
+    """
+    Chỉ mục IVF (inverted file) chỉ dùng NumPy, chạy được trên CPU không cần GPU.
+    Gallery được chia thành nlist cụm bằng spherical k-means; khi tìm kiếm chỉ chấm điểm
+    các hàng thuộc nprobe cụm gần probe nhất thay vì toàn bộ gallery.
+    """
+
+    def __init__(self, centroids, order, offsets, nprobe=8):
+        self.centroids = centroids
+        self.order = order        # Chỉ số hàng gallery, sắp xếp theo cụm
+        self.offsets = offsets    # Cụm c gồm order[offsets[c]:offsets[c + 1]]
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, matrix, nlist=0, nprobe=8, n_iter=10, seed=0):
+        """
+        Huấn luyện chỉ mục từ ma trận gallery đã chuẩn hoá L2.
+        Args:
+            matrix (ndarray): Ma trận float32 (n, d).
+            nlist (int): Số cụm, 0 để tự chọn khoảng sqrt(n).
+            nprobe (int): Số cụm được duyệt cho mỗi probe.
+        """
+        n = len(matrix)
+        if n == 0:
+            raise ValueError("Cannot build an IVF index on an empty gallery")
+        if nlist <= 0:
+            nlist = int(round(np.sqrt(n)))
+        nlist = max(1, min(nlist, n))
+
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(n, nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = (matrix @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, matrix)
+            counts = np.bincount(assign, minlength=nlist)
+            # Cụm rỗng được khởi tạo lại bằng một hàng ngẫu nhiên
+            empty = np.flatnonzero(counts == 0)
+            if len(empty) > 0:
+                sums[empty] = matrix[rng.choice(n, len(empty), replace=False)]
+            centroids = _normalize(sums)
+
+        assign = (matrix @ centroids.T).argmax(axis=1)
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=nlist))))
+        logger.info(f"Built IVF index: {n} rows, {nlist} lists, nprobe={nprobe}")
+        return cls(centroids, order, offsets, nprobe)
+
+    def candidates(self, probes):
+        """
+        Trả về, cho mỗi probe đã chuẩn hoá, mảng chỉ số các hàng gallery cần chấm điểm.
+        Nếu mọi cụm được duyệt đều rỗng (k-means có thể để lại cụm rỗng), chấm điểm toàn bộ gallery.
+        """
+        nprobe = min(self.nprobe, len(self.centroids))
+        centroid_scores = probes @ self.centroids.T
+        if nprobe < len(self.centroids):
+            nearest = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            nearest = np.broadcast_to(np.arange(nprobe), (len(probes), nprobe))
+        candidates = []
+        for lists in nearest:
+            rows = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists])
+            candidates.append(rows if len(rows) > 0 else self.order)
+        return candidates
+
+
+class TemplateIndex:
+    """
+    Mẫu tổng hợp theo người: centroid (trung bình đã chuẩn hoá) và vài exemplar đa dạng
+    (medoid rồi lần lượt lấy ảnh khác biệt nhất). Tìm kiếm hai bước: chấm điểm centroid
+    của mọi người trước, sau đó chỉ chấm điểm exemplar của shortlist người tốt nhất.
+    """
+
+    def __init__(self, centroids, exemplar_rows, exemplar_offsets, shortlist=5):
+        self.centroids = centroids
+        self.exemplar_rows = exemplar_rows        # Chỉ số hàng gallery, nhóm theo người
+        self.exemplar_offsets = exemplar_offsets  # Người p gồm exemplar_rows[offsets[p]:offsets[p + 1]]
+        self.shortlist = shortlist
+
+    @classmethod
+    def build(cls, matrix, labels, n_exemplars=3, shortlist=5):
+        """
+        Tạo mẫu tổng hợp từ ma trận gallery đã chuẩn hoá và nhãn người của từng hàng.
+        Args:
+            matrix (ndarray): Ma trận float32 (n, d).
+            labels (ndarray): Nhãn số nguyên 0..P-1 cho từng hàng.
+            n_exemplars (int): Số exemplar tối đa cho mỗi người.
+            shortlist (int): Số người được kiểm tra exemplar ở bước hai.
+        """
+        if len(matrix) == 0:
+            raise ValueError("Cannot build templates on an empty gallery")
+        n_persons = int(labels.max()) + 1
+        order = np.argsort(labels, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=n_persons))))
+
+        centroids = np.zeros((n_persons, matrix.shape[1]), dtype=np.float32)
+        exemplar_rows = []
+        exemplar_offsets = [0]
+        for p in range(n_persons):
+            rows = order[offsets[p]:offsets[p + 1]]
+            vectors = matrix[rows]
+            centroids[p] = vectors.mean(axis=0)
+
+            sims = vectors @ vectors.T
+            selected = [int(sims.sum(axis=1).argmax())]  # medoid
+            closest = sims[selected[0]].copy()
+            while len(selected) < min(n_exemplars, len(rows)):
+                nxt = int(closest.argmin())
+                selected.append(nxt)
+                closest = np.maximum(closest, sims[nxt])
+            exemplar_rows.extend(rows[selected])
+            exemplar_offsets.append(len(exemplar_rows))
+
+        logger.info(f"Built person templates: {n_persons} persons, {len(exemplar_rows)} exemplars "
+                    f"from {len(matrix)} rows, shortlist={shortlist}")
+        return cls(_normalize(centroids), np.asarray(exemplar_rows, dtype=np.int64),
+                   np.asarray(exemplar_offsets, dtype=np.int64), shortlist)
+
+    def candidates(self, probes):
+        """
+        Trả về, cho mỗi probe đã chuẩn hoá, exemplar của shortlist người có centroid gần nhất.
+        """
+        shortlist = min(self.shortlist, len(self.centroids))
+        centroid_scores = probes @ self.centroids.T
+        if shortlist < len(self.centroids):
+            nearest = np.argpartition(-centroid_scores, shortlist - 1, axis=1)[:, :shortlist]
+        else:
+            nearest = np.broadcast_to(np.arange(shortlist), (len(probes), shortlist))
+        return [
+            np.concatenate([self.exemplar_rows[self.exemplar_offsets[p]:self.exemplar_offsets[p + 1]] for p in persons])
+            for persons in nearest
+        ]
+
+
+def benchmark_search(gallery, approx_gallery, n_queries=200, noise=0.3, seed=0):
+    """
+    So sánh tìm kiếm chính xác và tìm kiếm xấp xỉ trên cùng một gallery.
+    Probe là các hàng gallery cộng nhiễu Gauss, giả lập ảnh chụp mới của người đã đăng ký.
+    Returns:
+        dict: recall@1 theo người và độ trễ trung bình (ms/probe) của hai cách tìm.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), min(n_queries, len(gallery)), replace=False)
+    probes = gallery.matrix[rows] + noise * rng.standard_normal((len(rows), gallery.matrix.shape[1])) / np.sqrt(gallery.matrix.shape[1])
+    probes = probes.astype(np.float32)
+
+    def timed(g):
+        start = time.perf_counter()
+        results = [g.best_match(p, threshold=-1.0) for p in probes]
+        return results, (time.perf_counter() - start) * 1000 / len(probes)
+
+    exact, exact_ms = timed(gallery)
+    approx, approx_ms = timed(approx_gallery)
+    hits = sum(1 for e, a in zip(exact, approx) if e.person_id == a.person_id)
+    return {
+        'gallery_size': len(gallery),
+        'queries': len(probes),
+        'recall_at_1': hits / len(probes),
+        'exact_ms': exact_ms,
+        'approx_ms': approx_ms,
+        'speedup': exact_ms / approx_ms if approx_ms > 0 else float('inf'),
+    }
+
+
+if __name__ == '__main__':
+    # python -m app.utils.ann_index [gallery_dir | embeddings.pkl] [ivf|centroid] [nlist] [nprobe]
+    from app.config import Config
+    from app.utils.gallery import load_gallery
+
+    path = sys.argv[1] if len(sys.argv) > 1 else Config.PATHS['gallery']
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'ivf'
+    # nlist/nprobe của IVF, mặc định lấy từ Config.RECOGNITION
+    options = dict(Config.RECOGNITION)
+    if len(sys.argv) > 3:
+        options['ivf_nlist'] = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        options['ivf_nprobe'] = int(sys.argv[4])
+
+    exact_gallery = load_gallery(path, search='exact')
+    if len(exact_gallery) == 0:
+        print(f"Gallery {path} is empty")
+        sys.exit(1)
+    approx_gallery = load_gallery(path, search='exact').set_search(mode, options)
+
+    report = benchmark_search(exact_gallery, approx_gallery)
+    print(f"Gallery: {report['gallery_size']} rows, {report['queries']} queries")
+    print(f"Recall@1 ({mode} vs exact): {report['recall_at_1']:.4f}")
+    print(f"Exact: {report['exact_ms']:.3f} ms/query")
+    print(f"{mode}: {report['approx_ms']:.3f} ms/query ({report['speedup']:.1f}x)")
@@ -0,0 +1,232 @@
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+import cv2
+import zmq
+from MySQLConnector import getConnector
+from app.config import Config
+from app.utils.face_service import FaceModels, ModelPool
+from app.utils.gallery_store import GalleryWatcher
+from app.utils.frame_source import LatestFrameReader
+from app.utils.camera_pipeline import DetectStage, EmbedStage, MatchStage, PublishStage
+from app.utils.motion import motion_region
+
+logger = logging.getLogger(__name__)
+
+SCORE_THRESH = 0.5
+
+
+class CameraWorker:
+    """
+    Một camera trong CameraHost: thread đọc camera riêng, còn detect/embed/match/publish chạy trên
+    thread suy luận nào đang rảnh, dùng pool mô hình và gallery chung của host.
+    Mỗi lúc chỉ một thread xử lý một camera, nên trạng thái theo dõi của camera không cần khoá.
+    """
+
+    def __init__(self, camera_id, camera_link, camera_type, camera_location, pool, gallery_watcher, on_frame):
+        self.camera_id = camera_id
+        self.location = camera_location
+        cap = cv2.VideoCapture(int(camera_link)) if int(camera_type) == 0 else cv2.VideoCapture(camera_link)
+        feedback = queue.Queue(1)
+        self.stages = [
+            DetectStage(pool=pool, motion_region=motion_region(camera_id)),
+            EmbedStage(None, feedback, pool=pool),
+            MatchStage(gallery_watcher.path, camera_id, camera_location, feedback, SCORE_THRESH,
+                       Config.RECOGNITION['min_margin'], gallery_watcher=gallery_watcher),
+            PublishStage(camera_id),
+        ]
+        self.processed = 0
+        self.frame_reader = LatestFrameReader(cap, name=f"camera-{camera_id}", on_frame=on_frame)
+
+    def process(self):
+        """Xử lý khung hình mới nhất (nếu có) qua tất cả các stage."""
+        ret, frame = self.frame_reader.read(timeout=0)
+        if not ret:
+            return
+        packet = {'frame_id': self.processed, 'time': datetime.now(), 'frame': frame}
+        for stage in self.stages:
+            packet = stage(packet)
+            if packet is None:
+                break
+        self.processed += 1
+
+    def stats(self):
+        # stages[0] là DetectStage: số lần phát hiện và duty cycle của cổng chuyển động
+        return dict(self.frame_reader.stats(), processed=self.processed, **self.stages[0].stats())
+
+    def close(self):
+        self.frame_reader.stop()
+        for stage in self.stages:
+            if hasattr(stage, 'close'):
+                stage.close()
+
+
+class CameraHost:
+    """
+    Một process chạy nhiều camera với một bộ mô hình (ModelPool) và một gallery dùng chung.
+    Bộ lập lịch chia khung hình của các camera cho inference_threads thread suy luận theo thứ tự
+    đến (FIFO, công bằng giữa các camera); camera đang được xử lý không được giao cho thread khác.
+    """
+
+    def __init__(self, inference_threads=None):
+        self.inference_threads = inference_threads or Config.CAMERA['inference_threads'] or os.cpu_count()
+        self.pool = ModelPool(lambda: FaceModels(Config.PATHS['yunet'], Config.PATHS['sface']),
+                              self.inference_threads)
+        self.gallery_watcher = GalleryWatcher(Config.PATHS['gallery'])
+        self.cameras = {}
+        self._condition = threading.Condition()
+        self._pending = deque()  # Camera có khung hình mới, theo thứ tự đến
+        self._busy = set()       # Camera đang được một thread suy luận xử lý
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._run_inference, name=f'inference-{i}', daemon=True)
+            for i in range(self.inference_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Camera host started with {self.inference_threads} inference threads")
+
+    def add_camera(self, camera_id):
+        camera_id = int(camera_id)
+        with self._condition:
+            if camera_id in self.cameras:
+                return False
+
+        conn = getConnector()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT link, name, status, type, location FROM face_application.camera where id=%s;",
+                           (camera_id,))
+            camera_infor = cursor.fetchone()
+        finally:
+            cursor.close()
+            conn.close()
+        if not camera_infor:
+            raise ValueError(f"No camera found with ID {camera_id}")
+        camera_link, camera_name, camera_status, camera_type, camera_location = camera_infor
+
+        worker = CameraWorker(camera_id, camera_link, camera_type, camera_location, self.pool,
+                              self.gallery_watcher, lambda: self._notify(camera_id))
+        with self._condition:
+            self.cameras[camera_id] = worker
+        logger.info(f"Added camera {camera_id} ({camera_name}) at {camera_location}")
+        return True
+
+    def remove_camera(self, camera_id):
+        camera_id = int(camera_id)
+        with self._condition:
+            worker = self.cameras.pop(camera_id, None)
+            if worker is None:
+                return False
+            # Chờ thread suy luận đang xử lý camera này (nếu có) xong rồi mới đóng
+            self._condition.wait_for(lambda: camera_id not in self._busy)
+        worker.close()
+        logger.info(f"Removed camera {camera_id}")
+        return True
+
+    def status(self):
+        with self._condition:
+            return {camera_id: worker.stats() for camera_id, worker in self.cameras.items()}
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for camera_id in list(self.cameras):
+            self.remove_camera(camera_id)
+
+    def _notify(self, camera_id):
+        with self._condition:
+            if camera_id not in self._pending:
+                self._pending.append(camera_id)
+                self._condition.notify()
+
+    def _next_camera(self):
+        """Lấy camera đầu tiên có khung hình mới và không bận, chờ nếu chưa có."""
+        while not self._stopped:
+            for camera_id in self._pending:
+                if camera_id not in self._busy:
+                    self._pending.remove(camera_id)
+                    worker = self.cameras.get(camera_id)
+                    if worker is None:
+                        break
+                    self._busy.add(camera_id)
+                    return worker
+            else:
+                self._condition.wait()
+        return None
+
+    def _run_inference(self):
+        while True:
+            with self._condition:
+                worker = self._next_camera()
+            if worker is None:
+                return
+            try:
+                worker.process()
+            except Exception as e:
+                logger.error(f"Error processing camera {worker.camera_id}: {e}")
+            finally:
+                with self._condition:
+                    self._busy.discard(worker.camera_id)
+                    self._condition.notify_all()
+
+
+def serve(host, port=None):
+    """
+    Nhận lệnh điều khiển qua ZeroMQ REP (JSON): {"cmd": "start"|"stop"|"status", "id": camera_id}.
+    Chặn tới khi nhận lệnh "shutdown".
+    """
+    port = port or Config.CAMERA['host_control_port']
+    socket = zmq.Context.instance().socket(zmq.REP)
+    socket.bind(f"tcp://127.0.0.1:{port}")
+    logger.info(f"Camera host listening for commands on port {port}")
+    while True:
+        message = socket.recv_json()
+        cmd = message.get('cmd')
+        try:
+            if cmd == 'start':
+                reply = {'status': 'success', 'started': host.add_camera(message['id'])}
+            elif cmd == 'stop':
+                reply = {'status': 'success', 'stopped': host.remove_camera(message['id'])}
+            elif cmd == 'status':
+                reply = {'status': 'success', 'cameras': {str(k): v for k, v in host.status().items()}}
+            elif cmd == 'shutdown':
+                socket.send_json({'status': 'success'})
+                break
+            else:
+                reply = {'status': 'error', 'message': f"Unknown command: {cmd}"}
+        except Exception as e:
+            logger.error(f"Error handling command {message}: {e}")
+            reply = {'status': 'error', 'message': str(e)}
+        socket.send_json(reply)
+    socket.close()
+    host.stop()
+
+
+if __name__ == '__main__':
+    # python -m app.utils.camera_host [camera_id ...]
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        handlers=[
+            logging.FileHandler('face_recognition.log'),
+            logging.StreamHandler()
+        ]
+    )
+    camera_host = CameraHost()
+    for arg in sys.argv[1:]:
+        camera_host.add_camera(arg)
+
+    def report():
+        while True:
+            time.sleep(Config.CAMERA['stats_interval'])
+            logger.info(f"Camera host frames: {camera_host.status()}")
+    threading.Thread(target=report, name='host-stats', daemon=True).start()
+
+    serve(camera_host)
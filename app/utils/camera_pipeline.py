@@ -0,0 +1,472 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from functools import partial
+from datetime import datetime
+import numpy as np
+import cv2
+from MySQLConnector import getConnector
+from app.config import Config
+from app.utils.gallery_store import GalleryWatcher
+from app.utils.frame_ring import FrameRingWriter
+from app.utils.frame_publisher import FramePublisher
+from app.utils.detection_scheduler import DetectionScheduler
+from app.utils.motion import MotionDetector, MotionGate, motion_region
+
+logger = logging.getLogger(__name__)
+
+# Gói tin báo dừng, đi qua lần lượt từng stage
+STOP = None
+
+
+def calculate_iou(box1, box2):
+    x1, y1, w1, h1 = box1
+    x2, y2, w2, h2 = box2
+    xi1, yi1, xi2, yi2 = max(x1, x2), max(y1, y2), min(x1+w1, x2+w2), min(y1+h1, y2+h2)
+    inter_area = max(0, xi2 - xi1) * max(0, yi2 - yi1)
+    box1_area = w1 * h1
+    box2_area = w2 * h2
+    union = float(box1_area + box2_area - inter_area)
+    return inter_area / union if union > 0 else 0.0
+
+
+def put_latest(q, item):
+    """Đưa item vào queue kích thước 1, thay thế item cũ chưa được đọc."""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def _stage_loop(name, factory, args, in_queue, out_queue, stats_interval):
+    if multiprocessing.current_process().name != 'MainProcess':
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    # Handler được tạo bên trong thread/process của stage, nên mô hình và kết nối thuộc riêng về stage đó
+    handler = factory(*args)
+    processed = 0
+    busy = 0.0
+    last_report = time.monotonic()
+    while True:
+        packet = in_queue.get()
+        if packet is STOP:
+            if hasattr(handler, 'close'):
+                handler.close()
+            if out_queue is not None:
+                out_queue.put(STOP)
+            return
+
+        started = time.perf_counter()
+        try:
+            result = handler(packet)
+        except Exception as e:
+            logger.error(f"Error in pipeline stage {name}: {e}")
+            result = None
+        busy += time.perf_counter() - started
+        processed += 1
+
+        if result is not None and out_queue is not None:
+            out_queue.put(result)
+
+        if time.monotonic() - last_report >= stats_interval:
+            logger.info(f"Stage {name}: {processed} packets, {1000 * busy / processed:.1f} ms/packet")
+            processed, busy, last_report = 0, 0.0, time.monotonic()
+
+
+class Pipeline:
+    """
+    Chuỗi stage nối với nhau bằng các queue có giới hạn. Mỗi stage chạy trong thread (mode='thread')
+    hoặc process riêng (mode='process'), nên thông lượng tiến tới stage chậm nhất thay vì tổng các stage.
+    Queue đầy thì stage trước bị chặn; kết hợp với LatestFrameReader, khung hình cũ bị bỏ ở đầu vào
+    thay vì dồn lại trong pipeline.
+    Args:
+        stages (list): Các bộ (tên, factory, args). factory(*args) được gọi trong thread/process
+            của stage và trả về handler: handler(packet) -> packet cho stage sau, hoặc None để bỏ packet.
+            Ở mode 'process', factory và args phải pickle được.
+    """
+
+    def __init__(self, stages, mode=None, queue_size=None):
+        self.mode = mode or Config.CAMERA['pipeline_mode']
+        queue_size = queue_size or Config.CAMERA['queue_size']
+        if self.mode == 'thread':
+            make_queue, make_worker = queue.Queue, threading.Thread
+        elif self.mode == 'process':
+            make_queue, make_worker = multiprocessing.Queue, multiprocessing.Process
+        else:
+            raise ValueError(f"Unknown pipeline mode: {self.mode}")
+
+        self._queues = [make_queue(queue_size) for _ in range(len(stages) + 1)]
+        self._workers = [
+            make_worker(target=_stage_loop, name=f'stage-{name}', daemon=True,
+                        args=(name, factory, args, self._queues[i], self._queues[i + 1],
+                              Config.CAMERA['stats_interval']))
+            for i, (name, factory, args) in enumerate(stages)
+        ]
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        logger.info(f"Started {len(self._workers)}-stage pipeline in {self.mode} mode")
+
+    def put(self, packet, timeout=None):
+        """Đưa packet vào stage đầu, chặn nếu stage đầu đang đầy."""
+        self._queues[0].put(packet, timeout=timeout)
+
+    def get(self, timeout=None):
+        """Lấy packet ra khỏi stage cuối. Raises: queue.Empty nếu hết thời gian chờ."""
+        return self._queues[-1].get(timeout=timeout)
+
+    def stop(self, timeout=5):
+        try:
+            self._queues[0].put(STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Pipeline did not accept the stop packet, stage workers are left to exit with the process")
+        for worker in self._workers:
+            worker.join(timeout)
+
+
+class DetectStage:
+    """
+    Giảm độ phân giải khung hình và phát hiện khuôn mặt bằng YuNet theo DetectionScheduler;
+    giữa hai lần phát hiện, vị trí khuôn mặt lấy từ tracker KCF (packet['detected'] = False).
+    Khi bật motion_gate, khung hình không có chuyển động trong motion_region bỏ qua cả resize,
+    phát hiện và tracker (packet['gated'] = True, không có khuôn mặt nào).
+    Dùng detector riêng, hoặc mượn từ pool dùng chung (face_service.ModelPool) nếu có pool.
+    """
+
+    def __init__(self, yunet_path=None, scale_factor=0.75, min_confidence=0.6, pool=None, scheduler=None,
+                 motion_region=None):
+        self.pool = pool
+        self.face_detector = None if pool else cv2.FaceDetectorYN.create(yunet_path, "", (640, 480))
+        self.scale_factor = scale_factor
+        self.min_confidence = min_confidence
+        self.scheduler = scheduler or DetectionScheduler()
+        self.motion = MotionDetector()
+        self.gate = MotionGate(motion_region) if Config.CAMERA['motion_gate'] else None
+        self.idle = False
+        self.trackers = []
+        self.last_report = time.monotonic()
+
+    def _detect(self, image):
+        if self.pool is not None:
+            with self.pool.checkout() as models:
+                return models.detect(image)
+        h, w = image.shape[:2]
+        self.face_detector.setInputSize((w, h))
+        faces = self.face_detector.detect(image)[1]
+        return faces if faces is not None else np.empty((0, 15), dtype=np.float32)
+
+    def _report(self):
+        if time.monotonic() - self.last_report < Config.CAMERA['stats_interval']:
+            return
+        self.last_report = time.monotonic()
+        logger.info(f"Detection schedule: {self.scheduler.stats()}")
+        if self.gate is not None:
+            logger.info(f"Motion gate: {self.gate.stats()}")
+
+    def stats(self):
+        """Bộ đếm phát hiện và duty cycle của cổng chuyển động."""
+        stats = {'detection': self.scheduler.stats()}
+        if self.gate is not None:
+            stats['motion_gate'] = self.gate.stats()
+        return stats
+
+    def _track(self, resized):
+        """Cập nhật các tracker. Returns: (các box theo ảnh thu nhỏ, mọi tracker còn bám được)."""
+        h, w = resized.shape[:2]
+        boxes = []
+        for tracker in self.trackers:
+            success, bbox = tracker.update(resized)
+            x, y, bw, bh = bbox
+            if not success or bw <= 0 or bh <= 0 or x + bw <= 0 or y + bh <= 0 or x >= w or y >= h:
+                return boxes, False
+            boxes.append([int(b) for b in bbox])
+        return boxes, True
+
+    def _start_trackers(self, resized, faces):
+        h, w = resized.shape[:2]
+        self.trackers = []
+        for face in faces:
+            x, y, bw, bh = face[:4].astype(np.int32)
+            x0, y0 = max(0, int(x)), max(0, int(y))
+            bw, bh = min(int(x + bw), w) - x0, min(int(y + bh), h) - y0
+            if bw <= 0 or bh <= 0:
+                continue
+            tracker = cv2.TrackerKCF_create()
+            tracker.init(resized, (x0, y0, bw, bh))
+            self.trackers.append(tracker)
+
+    def __call__(self, packet):
+        frame = packet['frame']
+        self._report()
+        if self.gate is not None and not self.gate.update(frame):
+            if not self.idle:
+                # Bắt đầu khoảng không xử lý: lần có chuyển động kế tiếp phát hiện lại từ đầu
+                self.idle = True
+                self.trackers = []
+                self.motion.reset()
+                self.scheduler.reset()
+            packet['gated'] = True
+            packet['detected'] = False
+            packet['resized'] = None
+            packet['faces'] = np.empty((0, 15), dtype=np.float32)
+            packet['boxes'] = []
+            return packet
+        self.idle = False
+        packet['gated'] = False
+
+        h, w = frame.shape[:2]
+        size = (int(w * self.scale_factor), int(h * self.scale_factor))
+        resized = cv2.resize(frame, size)
+
+        tracked, tracking_ok = self._track(resized)
+        motion = self.motion.changed_fraction(resized, exclude=tracked)
+        if self.scheduler.should_detect(tracking_ok, motion):
+            faces = self._detect(resized)
+            faces = faces[faces[:, 14] >= self.min_confidence]
+            self._start_trackers(resized, faces)
+            boxes = [face[:4].astype(np.int32) for face in faces]
+            packet['detected'] = True
+        else:
+            faces = np.empty((0, 15), dtype=np.float32)
+            boxes = tracked
+            packet['detected'] = False
+
+        packet['resized'] = resized
+        packet['faces'] = faces
+        packet['boxes'] = [[int(b / self.scale_factor) for b in box] for box in boxes]
+        return packet
+
+
+class EmbedStage:
+    """
+    Căn chỉnh và trích xuất đặc trưng SFace cho các khuôn mặt mới. Khuôn mặt trùng (IoU) với một
+    người đã nhận diện ở khung hình trước giữ nguyên nhãn, không phải trích xuất lại;
+    danh sách người đã nhận diện do MatchStage gửi ngược qua feedback. Khung hình chỉ có tracker
+    (packet['detected'] = False) không trích xuất gì, chỉ giữ nhãn cũ của từng khuôn mặt.
+    Dùng SFace riêng, hoặc mượn từ pool dùng chung nếu có pool.
+    """
+
+    def __init__(self, sface_path, feedback, iou_thresh=0.5, pool=None):
+        self.pool = pool
+        self.sface_model = None if pool else cv2.FaceRecognizerSF.create(sface_path, "")
+        self.feedback = feedback
+        self.iou_thresh = iou_thresh
+        self.known = []  # [(bbox, nhãn)] của khung hình gần nhất
+
+    def _known_label(self, box):
+        for known_box, label in self.known:
+            if not str(label).startswith("NA") and calculate_iou(box, known_box) > self.iou_thresh:
+                return label
+        return None
+
+    def _tracked_label(self, box):
+        # Khung hình chỉ có tracker: giữ nhãn của khuôn mặt trùng nhất ở khung hình trước, kể cả NA
+        best_label, best_iou = "NA", self.iou_thresh
+        for known_box, label in self.known:
+            iou = calculate_iou(box, known_box)
+            if iou > best_iou:
+                best_label, best_iou = label, iou
+        return best_label
+
+    def _embed(self, image, faces):
+        if self.pool is not None:
+            with self.pool.checkout() as models:
+                return [models.embed(image, face) for face in faces]
+        return [self.sface_model.feature(self.sface_model.alignCrop(image, face)) for face in faces]
+
+    def __call__(self, packet):
+        try:
+            self.known = self.feedback.get_nowait()
+        except queue.Empty:
+            pass
+
+        if packet['detected']:
+            labels = [self._known_label(box) for box in packet['boxes']]
+            rows = [i for i, label in enumerate(labels) if label is None]
+        else:
+            labels = [self._tracked_label(box) for box in packet['boxes']]
+            rows = []
+        features = self._embed(packet['resized'], packet['faces'][rows]) if rows else []
+
+        packet['labels'] = labels
+        packet['embed_rows'] = rows
+        packet['features'] = np.vstack(features) if features else np.empty((0, 128), dtype=np.float32)
+        # Ảnh thu nhỏ không cần cho các stage sau, không gửi tiếp
+        del packet['resized']
+        return packet
+
+
+class MatchStage:
+    """
+    So khớp các đặc trưng của khung hình với gallery trong một phép nhân ma trận, rồi ghi ảnh
+    thông báo và bản ghi recognise_history (mỗi người tối đa một lần mỗi redetect_interval giây).
+    Có thể dùng chung một GalleryWatcher giữa nhiều camera (gallery_watcher).
+    """
+
+    def __init__(self, gallery_path, camera_id, camera_location, feedback, score_thresh=0.5,
+                 min_margin=0.0, redetect_interval=30, notifications_dir=None, gallery_watcher=None):
+        self.gallery_watcher = gallery_watcher or GalleryWatcher(gallery_path)
+        logger.info(f"Loaded embeddings from {gallery_path}: {len(self.gallery_watcher.gallery)} entries")
+        self.conn = getConnector()
+        self.cursor = self.conn.cursor()
+        self.camera_id = camera_id
+        self.camera_location = camera_location
+        self.feedback = feedback
+        self.score_thresh = score_thresh
+        self.min_margin = min_margin
+        self.redetect_interval = redetect_interval
+        self.notifications_dir = notifications_dir or Config.PATHS['notifications']
+        self.last_recognized_time = {}  # nhãn -> datetime
+        self.previous_labels = set()
+
+    def __call__(self, packet):
+        # Gallery được tải lại trong thread nền khi có thay đổi, ở đây chỉ lấy bản mới nhất
+        gallery = self.gallery_watcher.gallery
+        rows = packet['embed_rows']
+        if rows:
+            matches = gallery.best_match_batch(packet['features'], self.score_thresh, self.min_margin)
+            for i, match in zip(rows, matches):
+                if match is not None and match.accepted:
+                    packet['labels'][i] = match.person_code
+                    self._record(packet, packet['boxes'][i], match.person_code, match.person_id)
+                else:
+                    packet['labels'][i] = "NA"
+                    self._record(packet, packet['boxes'][i], "NA", None)
+
+        # Người không còn trong khung hình được ghi nhận lại ngay khi xuất hiện trở lại.
+        # Khung hình bị cổng chuyển động bỏ qua không có khuôn mặt nào nhưng người vẫn có thể
+        # đứng yên trước camera, nên không tính là đã rời đi (tránh ghi lịch sử trùng khi cổng mở lại)
+        if not packet.get('gated'):
+            labels = set(packet['labels'])
+            for label in self.previous_labels - labels:
+                self.last_recognized_time.pop(label, None)
+            self.previous_labels = labels
+
+        put_latest(self.feedback, list(zip(packet['boxes'], packet['labels'])))
+        del packet['features']
+        return packet
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+    def _record(self, packet, bbox, label, person_id):
+        current_time = datetime.now()
+        if (label in self.last_recognized_time and
+                (current_time - self.last_recognized_time[label]).total_seconds() < self.redetect_interval):
+            logger.debug(f"Skipped capture for {label}: within {self.redetect_interval}s interval")
+            return
+        self.last_recognized_time[label] = current_time
+
+        p1 = (int(bbox[0]), int(bbox[1]))
+        p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
+        save_frame = packet['frame'].copy()
+        cv2.rectangle(save_frame, p1, p2, (255, 0, 0) if person_id is not None else (0, 0, 255), 2)
+        suffix = "" if person_id is not None else "_NA"
+        img_name = f"{self.camera_id}_{str(current_time).replace(':', '-').replace(' ', '-')}{suffix}.jpg"
+        # Lỗi lưu ảnh chỉ được ghi log, bản ghi recognise_history vẫn được thêm
+        try:
+            os.makedirs(self.notifications_dir, exist_ok=True)
+            cv2.imwrite(os.path.join(self.notifications_dir, img_name), save_frame)
+            logger.info(f"Saved recognition image to {self.notifications_dir}/{img_name}")
+        except Exception as e:
+            logger.error(f"Error saving image to {self.notifications_dir}/{img_name}: {e}")
+
+        try:
+            if person_id is not None:
+                self.cursor.execute("SELECT fullname, code FROM face_application.person WHERE id=%s", (person_id,))
+                result = self.cursor.fetchone()
+                if not result:
+                    logger.warning(f"No person found for ID {person_id}")
+                    return
+                fullname, personcode = result
+            else:
+                fullname, personcode = "Người lạ", "NA"
+            self.cursor.execute("""
+                INSERT INTO recognise_history (personcode, fullname, location, time, image)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (
+                personcode,
+                fullname,
+                self.camera_location,
+                current_time.strftime("%Y-%m-%d %H:%M:%S"),
+                img_name
+            ))
+            self.conn.commit()
+            logger.info(f"Ghi nhận: {fullname} ({personcode}) tại {self.camera_location}")
+        except Exception as e:
+            logger.error(f"Lỗi khi ghi nhận nhận diện: {e}")
+
+
+class PublishStage:
+    """
+    Vẽ khung và nhãn lên khung hình, ghi khung hình thô vào ring shared memory cho các process
+    cùng máy, và khi bật remote_stream thì gửi JPEG qua FramePublisher (cổng 8000 + camera_id),
+    chỉ mã hoá các mức chất lượng đang có người xem.
+    """
+
+    def __init__(self, camera_id, forward=False):
+        self.camera_id = camera_id
+        self.forward = forward
+        self.ring = FrameRingWriter(camera_id) if Config.CAMERA['shared_frames'] else None
+        self.publisher = FramePublisher(8000 + int(camera_id)) if Config.CAMERA['remote_stream'] else None
+
+    def __call__(self, packet):
+        frame = packet['frame']
+        # Ring nhận khung hình thô, ghi trước khi vẽ khung và nhãn lên frame
+        if self.ring is not None:
+            try:
+                self.ring.write(frame)
+            except Exception as e:
+                logger.error(f"Error writing frame to shared memory: {e}")
+
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        for bbox, label in zip(packet['boxes'], packet['labels']):
+            p1 = (int(bbox[0]), int(bbox[1]))
+            p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
+            cv2.rectangle(frame, p1, p2, (255, 0, 0), 2)
+            text_position = (p1[0], p1[1] - 10)
+            if str(label).startswith("NA"):
+                cv2.putText(frame, "NA", text_position, font, 0.7, (255, 0, 0), 2)
+            else:
+                cv2.putText(frame, str(label), text_position, font, 0.7, (0, 255, 0), 2)
+
+        if self.publisher is not None:
+            try:
+                self.publisher.send(frame)
+            except Exception as e:
+                logger.error(f"Error sending frame via ZeroMQ: {e}")
+        # Chỉ trả khung hình về process chính khi cần hiển thị
+        return packet if self.forward else None
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+        if self.publisher is not None:
+            self.publisher.close()
+
+
+def build_camera_pipeline(camera_id, camera_location, mode=None, show=False, yunet_path=None,
+                          sface_path=None, gallery_path=None, score_thresh=0.5, min_margin=None):
+    """
+    Tạo pipeline của một camera: detect -> embed -> match/persist -> annotate/encode/publish.
+    Stage capture là LatestFrameReader, chạy ngoài pipeline và đưa khung hình vào bằng Pipeline.put.
+    """
+    min_margin = Config.RECOGNITION['min_margin'] if min_margin is None else min_margin
+    mode = mode or Config.CAMERA['pipeline_mode']
+    feedback = queue.Queue(1) if mode == 'thread' else multiprocessing.Queue(1)
+    return Pipeline([
+        ('detect', partial(DetectStage, motion_region=motion_region(camera_id)), (yunet_path or Config.PATHS['yunet'],)),
+        ('embed', EmbedStage, (sface_path or Config.PATHS['sface'], feedback)),
+        ('match', MatchStage, (gallery_path or Config.PATHS['gallery'], camera_id, camera_location, feedback,
+                               score_thresh, min_margin)),
+        ('publish', PublishStage, (camera_id, show)),
+    ], mode=mode)
@@ -0,0 +1,65 @@
+import time
+from app.config import Config
+
+
+class DetectionScheduler:
+    """
+    Quyết định khung hình nào chạy YuNet; các khung hình còn lại dùng tracker KCF.
+    Phát hiện lại khi:
+      - chưa phát hiện lần nào hoặc vừa qua một khoảng không xử lý ('first'),
+      - một tracker mất dấu khuôn mặt ('tracker_lost'),
+      - có chuyển động ngoài các khuôn mặt đang theo dõi, có thể là người mới vào ('motion'),
+      - đã qua interval khung hình ('interval') hoặc max_age giây ('max_age') kể từ lần trước.
+    """
+
+    def __init__(self, interval=None, max_age=None, motion_threshold=None):
+        self.interval = Config.CAMERA['detect_interval'] if interval is None else interval
+        self.max_age = Config.CAMERA['detect_max_age'] if max_age is None else max_age
+        self.motion_threshold = (Config.CAMERA['detect_motion_threshold']
+                                 if motion_threshold is None else motion_threshold)
+        self.frames_since = 0
+        self.last_detection = None
+        self.frames = 0
+        self.reasons = {}  # lý do -> số lần phát hiện
+
+    def reset(self):
+        """Buộc phát hiện ở khung hình kế tiếp."""
+        self.last_detection = None
+        self.frames_since = 0
+
+    def should_detect(self, tracking_ok, motion):
+        """
+        Args:
+            tracking_ok (bool): Mọi tracker đều cập nhật thành công ở khung hình này.
+            motion (float): Tỉ lệ pixel thay đổi ngoài các khuôn mặt đang theo dõi.
+        Returns:
+            str: Lý do phát hiện, hoặc None nếu dùng tracker.
+        """
+        self.frames += 1
+        now = time.monotonic()
+        if self.last_detection is None:
+            reason = 'first'
+        elif not tracking_ok:
+            reason = 'tracker_lost'
+        elif motion > self.motion_threshold:
+            reason = 'motion'
+        elif self.interval and self.frames_since + 1 >= self.interval:
+            reason = 'interval'
+        elif self.max_age and now - self.last_detection >= self.max_age:
+            reason = 'max_age'
+        else:
+            self.frames_since += 1
+            return None
+
+        self.frames_since = 0
+        self.last_detection = now
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        return reason
+
+    def stats(self):
+        """Số khung hình, số lần phát hiện theo lý do."""
+        return {
+            'frames': self.frames,
+            'detections': sum(self.reasons.values()),
+            'reasons': dict(self.reasons),
+        }
@@ -0,0 +1,95 @@
+import hashlib
+import sqlite3
+import threading
+from functools import lru_cache
+import numpy as np
+from app.config import Config
+
+FEATURE_DTYPE = '<f4'
+FEATURE_DIM = 128
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-1 nội dung file ảnh, dùng làm khoá cache."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def model_version(yunet_path, sface_path):
+    """
+    Phiên bản mô hình: hash nội dung hai file ONNX YuNet và SFace.
+    Đổi một trong hai mô hình thì mọi embedding cũ trong cache tự động không còn khớp.
+    """
+    digest = hashlib.sha1()
+    for path in (yunet_path, sface_path):
+        digest.update(file_hash(path).encode())
+    return digest.hexdigest()[:16]
+
+
+class EmbeddingCache:
+    """
+    Cache lâu dài: (hash nội dung ảnh, phiên bản mô hình) -> các đặc trưng SFace (n, 128)
+    YuNet phát hiện được trên ảnh gốc.
+    Ảnh không có khuôn mặt cũng được lưu (n = 0) để không phải chạy lại YuNet.
+    Mỗi kết quả được commit ngay nên một lần rebuild bị gián đoạn có thể chạy tiếp từ chỗ dừng.
+    """
+
+    def __init__(self, path, version):
+        self.version = version
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(embeddings)")]
+        if columns and 'model_version' not in columns:
+            # Cache cũ không có phiên bản mô hình: bỏ đi, các ảnh sẽ được tính lại
+            self.conn.execute("DROP TABLE embeddings")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " image_hash TEXT NOT NULL,"
+            " model_version TEXT NOT NULL,"
+            " face_count INTEGER NOT NULL,"
+            " features BLOB NOT NULL,"
+            " PRIMARY KEY (image_hash, model_version))"
+        )
+        self.conn.commit()
+
+    @classmethod
+    def open_default(cls, yunet_path=None, sface_path=None):
+        """Mở cache Config.PATHS['embedding_cache'] cho các mô hình Config.PATHS['yunet'] và ['sface']."""
+        version = model_version(yunet_path or Config.PATHS['yunet'], sface_path or Config.PATHS['sface'])
+        return cls(Config.PATHS['embedding_cache'], version)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def get(self, image_hash):
+        """Returns: ndarray (n, 128) float32, hoặc None nếu chưa có trong cache."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT face_count, features FROM embeddings WHERE image_hash = ? AND model_version = ?",
+                (image_hash, self.version)
+            ).fetchone()
+        if row is None:
+            return None
+        face_count, blob = row
+        return np.frombuffer(blob, dtype=FEATURE_DTYPE).reshape(face_count, FEATURE_DIM)
+
+    def put(self, image_hash, features):
+        features = np.asarray(features, dtype=FEATURE_DTYPE).reshape(-1, FEATURE_DIM)
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO embeddings (image_hash, model_version, face_count, features) VALUES (?, ?, ?, ?)",
+                (image_hash, self.version, len(features), features.tobytes())
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
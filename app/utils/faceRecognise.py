@@ -1,11 +1,192 @@
+import re
 import sys
+import time
+import zipfile
 import cv2
 import os
 import numpy as np
-import pickle
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from MySQLConnector import getConnector
 
+# Cho phép import package app khi chạy trực tiếp: python app/utils/faceRecognise.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from app.config import Config
+from app.utils.face_service import get_face_service
+
+NO_FACE_MESSAGE = "Can't detect face"
+
+# Cài đặt các ngưỡng
+SCORE_THRESH = 0.5
+MIN_MARGIN = Config.RECOGNITION['min_margin']
+
+# Chuẩn bị truy vấn insert cho CSDL
+insert_query = """
+INSERT INTO timekeeping 
+(personcode, time, location, image_url, score)
+VALUES (%s, %s, %s, %s, %s)
+"""
+
+def match_frame(frame, service):
+    """
+    Nhận diện khuôn mặt đầu tiên trong ảnh.
+    Returns:
+        tuple: (MatchResult, None) nếu nhận diện được, ngược lại (None, thông báo lỗi).
+    """
+    # Detect faces using YuNet
+    faces = service.detect(frame)
+    if len(faces) == 0:
+        return None, NO_FACE_MESSAGE
+
+    # Căn chỉnh và trích xuất đặc trưng khuôn mặt đầu tiên
+    feature = service.embed(frame, faces[0])
+
+    # Lấy ứng viên tốt nhất trên toàn bộ gallery, từ chối nếu quá sát ứng viên tốt nhì
+    match = service.match(feature, SCORE_THRESH, MIN_MARGIN)
+    if match is None or not match.accepted:
+        return None, "Không nhận diện được khuôn mặt"
+    return match, None
+
+def recognise_frame(frame, img_name, service=None):
+    """
+    Nhận diện khuôn mặt trong ảnh đã giải mã và ghi bảng timekeeping nếu nhận diện được.
+    Dùng mô hình và gallery thường trú của service nên gọi được trực tiếp từ server cho mỗi request.
+    Args:
+        frame (ndarray): Ảnh BGR.
+        img_name (str): Tên file ảnh lưu vào cột image_url.
+        service (FaceService): Mặc định là dịch vụ dùng chung get_face_service().
+    Returns:
+        tuple: (True, thông báo) nếu nhận diện và ghi CSDL thành công, ngược lại (False, thông báo lỗi).
+    """
+    service = service or get_face_service()
+    match, error = match_frame(frame, service)
+    if error:
+        return False, error
+
+    # Ghi vào CSDL
+    try:
+        conn = getConnector()
+        cursor = conn.cursor()
+        try:
+            data = (
+                match.person_code, 
+                datetime.now(), 
+                'Đại đội 157',
+                img_name, 
+                match.score, 
+            )
+            cursor.execute(insert_query, data)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+    except Exception as e:
+        return False, f"error writting db: {e}"
+    return True, f"Mã nhân viên: {match.person_code}"
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Thời điểm chụp trong tên file, ví dụ capture_20240115_080312.jpg hoặc 20240115-080312_123456.jpg
+TIMESTAMP_PATTERN = re.compile(r'(\d{8})[_-]?(\d{6})')
+
+def image_timestamp(name, fallback):
+    """Thời điểm chụp lấy từ tên file, hoặc fallback (mtime / thời gian trong zip) nếu tên không có."""
+    found = TIMESTAMP_PATTERN.search(os.path.basename(name))
+    if found:
+        try:
+            return datetime.strptime(found.group(1) + found.group(2), '%Y%m%d%H%M%S')
+        except ValueError:
+            pass
+    return fallback
+
+def iter_batch_images(source):
+    """
+    Sinh (tên file, thời điểm chụp, bytes ảnh) cho mọi ảnh trong thư mục (đệ quy) hoặc file zip.
+    """
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                name = os.path.basename(info.filename)
+                yield name, image_timestamp(name, datetime(*info.date_time)), archive.read(info)
+        return
+
+    for root, _, files in os.walk(source):
+        for name in sorted(files):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            yield name, image_timestamp(name, datetime.fromtimestamp(os.path.getmtime(path))), data
+
+def _recognise_batch_image(name, taken_at, data, location, service):
+    frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return name, None, 'unreadable'
+    match, error = match_frame(frame, service)
+    if error:
+        return name, None, 'no_face' if error == NO_FACE_MESSAGE else 'unmatched'
+    return name, (match.person_code, taken_at, location, name, match.score), 'recognised'
+
+def recognise_batch(source, workers=None, location='Đại đội 157', chunk_size=500, service=None):
+    """
+    Chấm công bù từ một thư mục hoặc file zip ảnh có gắn thời điểm chụp (ví dụ ảnh của kiosk offline).
+    Ảnh được nhận diện song song trên một pool thread dùng chung mô hình thường trú,
+    rồi các bản ghi timekeeping được insert theo lô bằng executemany.
+    Args:
+        source (str): Thư mục hoặc file zip.
+        workers (int): Số thread nhận diện, mặc định bằng kích thước pool mô hình.
+        location (str): Giá trị cột location.
+        chunk_size (int): Số bản ghi mỗi lần executemany.
+    Returns:
+        dict: Thống kê số ảnh theo kết quả, số bản ghi đã insert và thời gian chạy.
+    """
+    started = time.perf_counter()
+    service = service or get_face_service()
+    workers = workers or service.pool.size
+    summary = {'images': 0, 'recognised': 0, 'unmatched': 0, 'no_face': 0, 'unreadable': 0, 'errors': 0,
+               'inserted': 0}
+    rows = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for name, taken_at, data in iter_batch_images(source):
+            summary['images'] += 1
+            pending.add(pool.submit(_recognise_batch_image, name, taken_at, data, location, service))
+            # Giới hạn số ảnh đang nằm trong bộ nhớ
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _collect_batch_results(done, rows, summary)
+        _collect_batch_results(pending, rows, summary)
+
+    conn = getConnector()
+    cursor = conn.cursor()
+    try:
+        for i in range(0, len(rows), chunk_size):
+            cursor.executemany(insert_query, rows[i:i + chunk_size])
+            conn.commit()
+            summary['inserted'] += len(rows[i:i + chunk_size])
+    finally:
+        cursor.close()
+        conn.close()
+
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    return summary
+
+def _collect_batch_results(futures, rows, summary):
+    for future in futures:
+        try:
+            name, row, status = future.result()
+        except Exception as e:
+            # Lỗi khi nhận diện (mô hình, gallery...) khác với ảnh không giải mã được
+            print(f"error processing image: {e}")
+            summary['errors'] += 1
+            continue
+        summary[status] += 1
+        if row is not None:
+            rows.append(row)
+
 def process_single_image(image_path):
     # Kiểm tra tồn tại của ảnh
     if not os.path.exists(image_path):
@@ -18,95 +199,26 @@ def process_single_image(image_path):
         print(f"error reading: {image_path}")
         sys.exit(1)
 
-    # Kết nối CSDL
-    conn = getConnector()
-    cursor = conn.cursor()
-
-    # Đường dẫn đến file chứa embeddings đã lưu
-    input_file = "embeddings.pkl"
-
-    # Đọc mảng embeddings từ file
-    with open(input_file, 'rb') as f:
-        personIds, showpersonIds, embeddings = pickle.load(f)
-
-    # Load YuNet model
-    face_detector = cv2.FaceDetectorYN.create("./weights/face_detection_yunet_2023mar.onnx", "", (640, 480))
-    
-    # Tải mô hình SFace để nhận diện khuôn mặt
-    sface_model = cv2.FaceRecognizerSF.create("./weights/face_recognition_sface_2021dec.onnx", "")
-
-    # Cài đặt các ngưỡng
-    SCORE_THRESH = 0.5
-    IOU_THRESH = 0.5
-
-    # Detect faces using YuNet
-    h, w, _ = frame.shape
-    face_detector.setInputSize((w, h))
-    faces = face_detector.detect(frame)
-
-    faces = faces[1]  # faces is a tuple (retval, faces)
-    if faces is None:
-        faces = []
-        print("Can't detect face")
-        sys.exit(1)
-
-    # Chuẩn bị truy vấn insert cho CSDL
-    insert_query = """
-    INSERT INTO timekeeping 
-    (personcode, time, location, image_url, score)
-    VALUES (%s, %s, %s, %s, %s)
-    """
-
-    # Xử lý từng khuôn mặt
-    for face in faces:
-        x, y, w, h = face[:4].astype(np.int32)
-        bbox = (x, y, w, h)
-
-        # Căn chỉnh và trích xuất đặc trưng khuôn mặt
-        aligned_face = sface_model.alignCrop(frame, face)
-        feature = sface_model.feature(aligned_face)
-
-        # Nhận diện khuôn mặt
-        detected = False
-        matched_person_id = None
-        matched_dist = 0
-
-        for i in range(len(embeddings)):
-            dist = sface_model.match(embeddings[i], feature)
-            if dist > SCORE_THRESH:
-                detected = True
-                matched_person_id = showpersonIds[i]
-                matched_dist = dist
-                break
-
-        # Ghi vào CSDL nếu nhận diện được
-        if detected:
-            try:
-                # Sử dụng tên file gốc đã được tạo từ hàm process_face_recognition
-                img_name = os.path.basename(image_path)
-                data = (
-                    matched_person_id, 
-                    datetime.now(), 
-                    'Đại đội 157',
-                    img_name, 
-                    matched_dist, 
-                )
-                cursor.execute(insert_query, data)
-                conn.commit()
-                print(f"Mã nhân viên: {matched_person_id}")
-                sys.exit(0)  # Thoát với mã trạng thái thành công
-            except Exception as e:
-                print(f"error writting db: {e}")
-                sys.exit(1)
-        else:
-            print("Không nhận diện được khuôn mặt")
-            sys.exit(1)
+    # Sử dụng tên file gốc đã được tạo từ hàm process_face_recognition
+    success, message = recognise_frame(frame, os.path.basename(image_path))
+    print(message)
+    sys.exit(0 if success else 1)
 
 # Kiểm tra và xử lý đầu vào
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("provide image")
         sys.exit(1)
+
+    # Chấm công bù: python faceRecognise.py --batch <thư mục | file.zip> [số thread]
+    if sys.argv[1] == '--batch':
+        if len(sys.argv) < 3:
+            print("provide a directory or zip file")
+            sys.exit(1)
+        report = recognise_batch(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+        for key, value in report.items():
+            print(f"{key}: {value}")
+        sys.exit(0)
     
     image_path = sys.argv[1]
-    process_single_image(image_path)
\ No newline at end of file
+    process_single_image(image_path)
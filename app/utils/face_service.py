@@ -0,0 +1,286 @@
+import os
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+import numpy as np
+import cv2
+from app.config import Config
+from app.utils.gallery_store import GalleryWatcher
+
+logger = logging.getLogger(__name__)
+
+
+class FaceModels:
+    """
+    Một cặp YuNet + SFace. setInputSize thay đổi trạng thái detector nên mỗi instance
+    chỉ được một thread dùng tại một thời điểm, thông qua ModelPool.checkout.
+    """
+
+    def __init__(self, yunet_path, sface_path):
+        self.face_detector = cv2.FaceDetectorYN.create(yunet_path, "", (640, 480))
+        self.sface_model = cv2.FaceRecognizerSF.create(sface_path, "")
+        self.sface_path = sface_path
+        self._sface_net = None  # Mạng SFace cho embed_batch, chỉ tạo khi dùng micro-batching
+        self.batched = True
+
+    def detect(self, frame):
+        """
+        Phát hiện khuôn mặt.
+        Returns:
+            ndarray: Các khuôn mặt YuNet (n, 15), n = 0 nếu không có khuôn mặt.
+        """
+        h, w = frame.shape[:2]
+        self.face_detector.setInputSize((w, h))
+        faces = self.face_detector.detect(frame)[1]
+        if faces is None:
+            return np.empty((0, 15), dtype=np.float32)
+        return faces
+
+    def align(self, frame, face):
+        """Căn chỉnh khuôn mặt về ảnh 112x112 theo 5 điểm mốc của YuNet."""
+        return self.sface_model.alignCrop(frame, face)
+
+    def embed(self, frame, face):
+        """Căn chỉnh khuôn mặt và trích xuất đặc trưng SFace (1, 128)."""
+        return self.sface_model.feature(self.align(frame, face))
+
+    def embed_batch(self, aligned_faces):
+        """
+        Trích xuất đặc trưng SFace của nhiều khuôn mặt đã căn chỉnh trong một lần forward.
+        Blob được tạo giống FaceRecognizerSF.feature: 112x112, swapRB, không chuẩn hoá thêm.
+        Nếu forward theo batch lỗi (ví dụ mô hình cố định batch 1), chạy lại từng khuôn mặt.
+        Returns:
+            ndarray: (n, 128).
+        """
+        if self._sface_net is None:
+            self._sface_net = cv2.dnn.readNet(self.sface_path)
+        if self.batched and len(aligned_faces) > 1:
+            try:
+                blob = cv2.dnn.blobFromImages(aligned_faces, 1.0, (112, 112), (0, 0, 0), swapRB=True, crop=False)
+                self._sface_net.setInput(blob)
+                return self._sface_net.forward().reshape(len(aligned_faces), -1)
+            except cv2.error as e:
+                logger.warning(f"Batched SFace forward failed, falling back to one face per forward: {str(e)}")
+                self.batched = False
+        features = []
+        for aligned_face in aligned_faces:
+            blob = cv2.dnn.blobFromImage(aligned_face, 1.0, (112, 112), (0, 0, 0), swapRB=True, crop=False)
+            self._sface_net.setInput(blob)
+            features.append(self._sface_net.forward().reshape(-1))
+        return np.vstack(features)
+
+
+class ModelPool:
+    """
+    Pool có giới hạn các FaceModels. Instance được tạo dần khi cần, tối đa size cái;
+    khi tất cả đang bận, checkout chờ tới khi có instance được trả lại.
+    """
+
+    def __init__(self, factory, size):
+        self.size = max(1, size)
+        self._factory = factory
+        self._idle = queue.LifoQueue()  # Instance vừa dùng xong còn nóng cache CPU
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """
+        Mượn một instance trong khối with, tự trả lại khi ra khỏi khối.
+        Raises:
+            TimeoutError: Không có instance rảnh trong timeout giây.
+        """
+        models = self._acquire(timeout)
+        try:
+            yield models
+        finally:
+            self._idle.put(models)
+
+    def _acquire(self, timeout):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                models = self._factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+            logger.info(f"Created face models instance {self._created}/{self.size}")
+            return models
+
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No face models instance available after {timeout}s")
+
+
+class EmbeddingBatcher:
+    """
+    Gom các khuôn mặt đã căn chỉnh từ nhiều request đồng thời trong tối đa max_wait_ms
+    (hoặc tới khi đủ max_batch), chạy SFace một lần trên blob xếp chồng (FaceModels.embed_batch)
+    rồi chấm điểm cả batch với gallery bằng một phép nhân ma trận (Gallery.best_match_batch).
+    Có một thread gom batch cho mỗi instance của pool và mỗi batch chạy trên một instance mượn
+    từ pool, nên các batch chạy song song trên nhiều core, chung giới hạn với detect/align.
+    """
+
+    def __init__(self, pool, gallery_getter, max_batch=16, max_wait_ms=5):
+        self.pool = pool
+        self.gallery_getter = gallery_getter
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._run, name=f'embedding-batcher-{i}', daemon=True)
+            for i in range(pool.size)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, aligned_face, threshold, min_margin=0.0):
+        """
+        Đưa một khuôn mặt đã căn chỉnh vào batch kế tiếp.
+        Returns:
+            Future: Kết quả là MatchResult (None nếu gallery rỗng). Future bị huỷ trước khi
+                vào batch thì không được xử lý.
+        """
+        future = Future()
+        self._queue.put((aligned_face, threshold, min_margin, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Bỏ các request đã hết thời gian chờ và huỷ future
+            batch = [item for item in batch if item[3].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._process(batch)
+            except Exception as e:
+                logger.error(f"Error in embedding batch of {len(batch)}: {str(e)}")
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch):
+        with self.pool.checkout() as models:
+            features = models.embed_batch([item[0] for item in batch])
+        gallery = self.gallery_getter()
+
+        # Các request cùng ngưỡng được chấm điểm chung một phép nhân ma trận
+        groups = {}
+        for i, (_, threshold, min_margin, _) in enumerate(batch):
+            groups.setdefault((threshold, min_margin), []).append(i)
+        for (threshold, min_margin), rows in groups.items():
+            matches = gallery.best_match_batch(features[rows], threshold, min_margin)
+            for i, match in zip(rows, matches):
+                batch[i][3].set_result(match)
+
+
+class FaceService:
+    """
+    Dịch vụ nhận diện dùng chung trong process: gallery chỉ được tải một lần rồi phục vụ mọi
+    request của Flask, được GalleryWatcher tải lại ở nền khi thay đổi. Mô hình nằm trong một
+    ModelPool kích thước Config.RECOGNITION['model_pool_size'], nên các request đồng thời chạy
+    song song trên nhiều core mà không dùng chung một detector.
+    """
+
+    def __init__(self, yunet_path=None, sface_path=None, gallery_path=None, pool_size=None):
+        yunet_path = yunet_path or Config.PATHS['yunet']
+        sface_path = sface_path or Config.PATHS['sface']
+        pool_size = pool_size or Config.RECOGNITION['model_pool_size'] or os.cpu_count()
+        self.pool = ModelPool(lambda: FaceModels(yunet_path, sface_path), pool_size)
+        # Tạo sẵn một instance để lỗi đường dẫn mô hình lộ ra ngay khi khởi tạo
+        with self.pool.checkout():
+            pass
+        self.gallery_watcher = GalleryWatcher(gallery_path or Config.PATHS['gallery'])
+        # Gom SFace của các request đồng thời, tắt khi batch_max_size <= 1
+        self.batcher = None
+        if Config.RECOGNITION['batch_max_size'] > 1:
+            self.batcher = EmbeddingBatcher(self.pool, lambda: self.gallery, Config.RECOGNITION['batch_max_size'],
+                                            Config.RECOGNITION['batch_max_wait_ms'])
+        logger.info(f"Initialized face service, model pool size {self.pool.size}")
+
+    @property
+    def gallery(self):
+        return self.gallery_watcher.gallery
+
+    def detect(self, frame):
+        """Phát hiện khuôn mặt, xem FaceModels.detect."""
+        with self.pool.checkout() as models:
+            return models.detect(frame)
+
+    def align(self, frame, face):
+        """Căn chỉnh khuôn mặt về ảnh 112x112, xem FaceModels.align."""
+        with self.pool.checkout() as models:
+            return models.align(frame, face)
+
+    def embed(self, frame, face):
+        """Trích xuất đặc trưng SFace (1, 128), xem FaceModels.embed."""
+        with self.pool.checkout() as models:
+            return models.embed(frame, face)
+
+    def match(self, feature, threshold, min_margin=0.0):
+        """So khớp với gallery hiện tại, xem Gallery.best_match. Trả về None nếu gallery rỗng."""
+        return self.gallery.best_match(feature, threshold, min_margin)
+
+    def match_aligned(self, aligned_face, threshold, min_margin=0.0, timeout=None):
+        """
+        Trích xuất đặc trưng từ khuôn mặt đã căn chỉnh và so khớp với gallery.
+        Khi bật micro-batching, SFace và bước chấm điểm chạy chung batch với các request đồng thời.
+        Args:
+            timeout (float): Thời gian chờ tối đa (giây), mặc định Config.RECOGNITION['match_timeout'].
+        Raises:
+            TimeoutError: Quá tải, không có kết quả trong timeout giây.
+        """
+        timeout = Config.RECOGNITION['match_timeout'] if timeout is None else timeout
+        if self.batcher is not None:
+            future = self.batcher.submit(aligned_face, threshold, min_margin)
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise TimeoutError(f"No embedding result after {timeout}s")
+        with self.pool.checkout(timeout) as models:
+            feature = models.sface_model.feature(aligned_face)
+        return self.match(feature, threshold, min_margin)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_face_service():
+    """Trả về FaceService dùng chung, tạo ở lần gọi đầu tiên."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = FaceService()
+    return _service
+
+
+def notify_gallery_changed():
+    """Báo gallery vừa thay đổi (ví dụ sau add_face) để dịch vụ tải lại ngay nếu đã được tạo."""
+    if _service is not None:
+        _service.gallery_watcher.notify()
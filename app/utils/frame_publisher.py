@@ -0,0 +1,102 @@
+import time
+import logging
+from collections import namedtuple
+import cv2
+import zmq
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+StreamTier = namedtuple('StreamTier', ['scale', 'quality', 'max_fps'])
+
+
+def parse_tiers(spec):
+    """
+    Đọc cấu hình mức chất lượng 'topic:scale:quality:max_fps,...'.
+    Returns:
+        dict: topic -> StreamTier.
+    """
+    tiers = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        topic, scale, quality, max_fps = item.strip().split(':')
+        tiers[topic] = StreamTier(float(scale), int(quality), float(max_fps))
+    return tiers
+
+
+class FramePublisher:
+    """
+    Gửi khung hình JPEG qua ZeroMQ XPUB, mỗi topic là một mức chất lượng (kích thước, chất lượng
+    JPEG, fps tối đa). XPUB nhận thông báo đăng ký/huỷ đăng ký của subscriber, nên topic không có ai
+    xem thì không mã hoá; camera không ai xem không tốn CPU cho việc mã hoá.
+    """
+
+    def __init__(self, port, tiers=None):
+        self.port = port
+        self.tiers = parse_tiers(Config.CAMERA['stream_tiers']) if tiers is None else tiers
+        self.socket = zmq.Context.instance().socket(zmq.XPUB)
+        self.socket.bind(f"tcp://*:{port}")
+        self.subscriptions = set()  # Các prefix topic đang có subscriber
+        self._last_sent = dict.fromkeys(self.tiers, 0.0)
+        self.sent = dict.fromkeys(self.tiers, 0)
+        self.unwatched = 0  # Số khung hình không mã hoá vì không ai xem
+        logger.info(f"ZeroMQ publisher bound to port {port} with topics {list(self.tiers)}")
+
+    def _poll_subscriptions(self):
+        # XPUB báo byte đầu 1 khi topic có subscriber đầu tiên, 0 khi subscriber cuối cùng rời đi
+        while True:
+            try:
+                message = self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if not message:
+                continue
+            prefix = message[1:]
+            if message[0] == 1:
+                self.subscriptions.add(prefix)
+                logger.info(f"Viewer subscribed to '{prefix.decode(errors='replace')}' on port {self.port}")
+            elif message[0] == 0:
+                self.subscriptions.discard(prefix)
+                logger.info(f"Last viewer of '{prefix.decode(errors='replace')}' left port {self.port}")
+
+    def watched(self, topic):
+        topic = topic.encode()
+        return any(topic.startswith(prefix) for prefix in self.subscriptions)
+
+    def send(self, frame):
+        """
+        Mã hoá và gửi khung hình cho các topic đang có người xem và chưa vượt fps tối đa.
+        Returns:
+            int: Số topic đã gửi.
+        """
+        self._poll_subscriptions()
+        if not self.subscriptions:
+            self.unwatched += 1
+            return 0
+
+        now = time.monotonic()
+        count = 0
+        for topic, tier in self.tiers.items():
+            if not self.watched(topic):
+                continue
+            if tier.max_fps > 0 and now - self._last_sent[topic] < 1.0 / tier.max_fps:
+                continue
+            image = frame
+            if tier.scale != 1.0:
+                image = cv2.resize(frame, None, fx=tier.scale, fy=tier.scale, interpolation=cv2.INTER_AREA)
+            ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, tier.quality])
+            if not ok:
+                continue
+            self.socket.send_string(topic, zmq.SNDMORE)
+            self.socket.send(buffer.tobytes())
+            self._last_sent[topic] = now
+            self.sent[topic] += 1
+            count += 1
+        return count
+
+    def stats(self):
+        return {'sent': dict(self.sent), 'unwatched': self.unwatched}
+
+    def close(self):
+        self.socket.close(linger=0)
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import logging
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import cv2
+import zmq
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Vùng đầu của shared memory: số thứ tự (uint64) của khung hình đang nằm trong từng slot, 0 = đang ghi
+HEADER_ALIGN = 64
+
+
+def ring_name(camera_id):
+    return f"camera_{int(camera_id)}_frames"
+
+
+def ring_port(camera_id):
+    return Config.CAMERA['ring_port_base'] + int(camera_id)
+
+
+def _header_size(slots):
+    return -(-slots * 8 // HEADER_ALIGN) * HEADER_ALIGN
+
+
+class FrameRingWriter:
+    """
+    Ghi khung hình thô (BGR, không mã hoá) vào ring buffer trong shared memory của một camera
+    và báo slot vừa ghi qua ZeroMQ PUB (tcp://127.0.0.1:ring_port_base + camera_id).
+    Các process cùng máy (ghi hình, xem trước trên API, phân tích) đọc thẳng từ shared memory
+    bằng FrameRingReader, không phải giải mã JPEG.
+    Ring được tạo ở khung hình đầu tiên; khung hình khác kích thước sau đó được resize về kích thước ring.
+    """
+
+    def __init__(self, camera_id, slots=None, port=None):
+        self.camera_id = camera_id
+        self.name = ring_name(camera_id)
+        self.slots = slots or Config.CAMERA['ring_slots']
+        self.shm = None
+        self.shape = None
+        self.generation = None
+        self.sequence = 0
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, 1)
+        self.port = port or ring_port(camera_id)
+        self.socket.bind(f"tcp://127.0.0.1:{self.port}")
+        logger.info(f"Frame ring notifications for camera {camera_id} on port {self.port}")
+
+    def _create(self, shape):
+        nbytes = int(np.prod(shape))
+        size = _header_size(self.slots) + self.slots * nbytes
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            # Segment còn sót lại từ lần chạy trước bị dừng đột ngột
+            stale = shared_memory.SharedMemory(name=self.name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        self.shape = shape
+        # Đổi mỗi lần tạo lại segment, để người đọc biết phải gắn lại dù tên segment không đổi
+        self.generation = time.time_ns()
+        self._header = np.ndarray((self.slots,), dtype=np.uint64, buffer=self.shm.buf)
+        self._header[:] = 0
+        self._frames = np.ndarray((self.slots,) + shape, dtype=np.uint8, buffer=self.shm.buf,
+                                  offset=_header_size(self.slots))
+        logger.info(f"Created frame ring {self.name}: {self.slots} slots of {shape}")
+
+    def write(self, frame):
+        """Chép khung hình vào slot kế tiếp và gửi thông báo {slot, seq, shape}."""
+        if frame.dtype != np.uint8:
+            frame = frame.astype(np.uint8)
+        if self.shm is None:
+            self._create(frame.shape)
+        elif frame.shape != self.shape:
+            frame = cv2.resize(frame, (self.shape[1], self.shape[0]))
+        self.sequence += 1
+        slot = self.sequence % self.slots
+        self._header[slot] = 0
+        self._frames[slot] = frame
+        self._header[slot] = self.sequence
+        try:
+            self.socket.send_json({
+                'shm': self.name,
+                'generation': self.generation,
+                'slots': self.slots,
+                'slot': slot,
+                'seq': self.sequence,
+                'shape': self.shape,
+                'time': time.time(),
+            }, zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+    def close(self):
+        self.socket.close(linger=0)
+        if self.shm is not None:
+            del self._header, self._frames
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def _open_unowned(name):
+    """
+    Mở segment do process khác tạo. Người đọc không sở hữu segment: không để resource_tracker
+    của process này xoá nó khi thoát (Python 3.13+ có track=False; trước đó chỉ POSIX đăng ký
+    segment với resource_tracker, Windows tự giải phóng khi handle cuối cùng đóng).
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == 'posix':
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class FrameRingReader:
+    """
+    Đọc khung hình mới nhất của một camera từ FrameRingWriter trên cùng máy.
+    Socket SUB dùng CONFLATE nên chỉ giữ thông báo mới nhất; khung hình bị ghi đè trong lúc
+    đang chép (người đọc chậm hơn ring_slots khung hình) được bỏ qua và đếm trong stale.
+    """
+
+    def __init__(self, camera_id, port=None):
+        self.camera_id = camera_id
+        self.socket = zmq.Context.instance().socket(zmq.SUB)
+        self.socket.setsockopt(zmq.CONFLATE, 1)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b"")
+        self.socket.connect(f"tcp://127.0.0.1:{port or ring_port(camera_id)}")
+        self.shm = None
+        self._generation = None
+        self.received = 0   # Số khung hình đọc được
+        self.stale = 0      # Số khung hình đã bị ghi đè trước khi đọc xong
+
+    def _attach(self, message):
+        if self.shm is not None and self._generation == message['generation']:
+            return
+        self._detach()
+        self.shm = _open_unowned(message['shm'])
+        slots, shape = message['slots'], tuple(message['shape'])
+        self._generation = message['generation']
+        self._header = np.ndarray((slots,), dtype=np.uint64, buffer=self.shm.buf)
+        self._frames = np.ndarray((slots,) + shape, dtype=np.uint8, buffer=self.shm.buf,
+                                  offset=_header_size(slots))
+
+    def _detach(self):
+        if self.shm is not None:
+            del self._header, self._frames
+            self.shm.close()
+            self.shm = None
+
+    def read(self, timeout=None, copy=True):
+        """
+        Chờ tối đa timeout giây (None = chờ mãi) khung hình mới.
+        Args:
+            copy (bool): False trả về view trực tiếp vào shared memory (không chép), chỉ hợp lệ
+                tới khi writer quay lại ghi đè slot đó.
+        Returns:
+            tuple: (True, frame) hoặc (False, None) nếu hết thời gian chờ hay khung hình đã bị ghi đè.
+        """
+        if not self.socket.poll(None if timeout is None else int(timeout * 1000)):
+            return False, None
+        message = self.socket.recv_json()
+        try:
+            self._attach(message)
+        except FileNotFoundError:
+            return False, None
+        slot, seq = message['slot'], message['seq']
+        if self._header[slot] != seq:
+            self.stale += 1
+            return False, None
+        frame = self._frames[slot]
+        if copy:
+            frame = frame.copy()
+            if self._header[slot] != seq:
+                self.stale += 1
+                return False, None
+        self.received += 1
+        return True, frame
+
+    def close(self):
+        self.socket.close(linger=0)
+        self._detach()
@@ -0,0 +1,82 @@
+import time
+import logging
+import threading
+from collections import deque
+import cv2
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class LatestFrameReader:
+    """
+    Đọc camera trong một thread riêng và chỉ giữ vài khung hình mới nhất trong ring buffer.
+    Vòng lặp xử lý luôn nhận khung hình mới nhất; các khung hình cũ hơn chưa kịp xử lý bị bỏ
+    (được đếm trong dropped), nên độ trễ so với thực tế không tăng theo tải nhận diện.
+    """
+
+    def __init__(self, cap, buffer_size=None, name='camera', on_frame=None):
+        self.cap = cap
+        self.name = name
+        self.on_frame = on_frame  # Gọi (trong thread đọc camera) mỗi khi có khung hình mới
+        # Giảm hàng đợi nội bộ của backend (nếu hỗ trợ) để khung hình không cũ đi trước khi tới ring buffer
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self._frames = deque(maxlen=buffer_size or Config.CAMERA['buffer_size'])
+        self._condition = threading.Condition()
+        self._stopped = False
+        self.captured = 0        # Số khung hình đọc được từ camera
+        self.delivered = 0       # Số khung hình đã giao cho vòng lặp xử lý
+        self.dropped = 0         # Số khung hình bị bỏ vì đã có khung hình mới hơn
+        self.read_failures = 0   # Số lần cap.read() thất bại
+        self._thread = threading.Thread(target=self._run, name=f'{name}-capture', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            ret, frame = self.cap.read()
+            if not ret:
+                self.read_failures += 1
+                logger.error(f"Failed to read frame from {self.name}")
+                time.sleep(1)
+                continue
+            with self._condition:
+                if len(self._frames) == self._frames.maxlen:
+                    self.dropped += 1
+                self._frames.append((time.monotonic(), frame))
+                self.captured += 1
+                self._condition.notify()
+            if self.on_frame is not None:
+                self.on_frame()
+
+    def read(self, timeout=None):
+        """
+        Lấy khung hình mới nhất chưa được giao, chờ tối đa timeout giây nếu chưa có.
+        Returns:
+            tuple: (True, frame) hoặc (False, None) nếu hết thời gian chờ hay reader đã dừng.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._frames or self._stopped, timeout):
+                return False, None
+            if not self._frames:
+                return False, None
+            _, frame = self._frames.pop()
+            self.dropped += len(self._frames)
+            self._frames.clear()
+            self.delivered += 1
+            return True, frame
+
+    def stats(self):
+        """Bộ đếm khung hình: captured, delivered, dropped, read_failures."""
+        return {
+            'captured': self.captured,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'read_failures': self.read_failures,
+        }
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout=2)
+        self.cap.release()
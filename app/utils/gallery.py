@@ -0,0 +1,279 @@
+import os
+import pickle
+import logging
+from collections import namedtuple
+import numpy as np
+from app.config import Config
+from app.utils.ann_index import IVFIndex, TemplateIndex
+
+logger = logging.getLogger(__name__)
+
+FEATURE_DIM = 128
+
+# Kết quả so khớp tốt nhất của một probe.
+# runner_up_* là ứng viên tốt nhất thuộc một người KHÁC; margin = score - runner_up_score.
+MatchResult = namedtuple('MatchResult', [
+    'index', 'person_id', 'person_code', 'score',
+    'runner_up_id', 'runner_up_code', 'runner_up_score', 'margin', 'accepted',
+])
+
+
+def normalize_rows(features):
+    """
+    Chuẩn hoá L2 từng hàng, trả về ma trận float32 (n, d).
+    Chấp nhận một vector (d,), một đặc trưng SFace (1, d) hoặc một danh sách các vector.
+    """
+    matrix = np.asarray(features, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[np.newaxis, :]
+    matrix = matrix.reshape(matrix.shape[0], -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+class Gallery:
+    """
+    Tập embeddings đã đăng ký, lưu trong một ma trận float32 liền mạch đã chuẩn hoá L2.
+    Điểm so khớp là cosine similarity, tương đương sface_model.match(..., FR_COSINE),
+    nên toàn bộ gallery được chấm điểm bằng một phép nhân ma trận.
+    Các hàng extra (ví dụ log của gallery_store) nằm trong một khối nhỏ riêng, được chấm điểm
+    cùng ma trận chính mà không ghép hai khối, nên ma trận memmap không bị sao chép.
+    """
+
+    def __init__(self, person_ids, person_codes, matrix, normalized=False, extra=None):
+        extra = (np.empty((0, FEATURE_DIM), dtype=np.float32) if extra is None or len(extra) == 0
+                 else normalize_rows(extra))
+        if len(person_ids) != len(person_codes) or len(person_ids) != len(matrix) + len(extra):
+            raise ValueError("person_ids, person_codes and embeddings must have the same length")
+        self.person_ids = list(person_ids)
+        self.person_codes = list(person_codes)
+        # Nhãn số nguyên cho từng hàng: các hàng cùng một người có cùng nhãn
+        label_of = {}
+        self.labels = np.array([label_of.setdefault(pid, len(label_of)) for pid in self.person_ids], dtype=np.int64)
+        if len(matrix) == 0:
+            self._base = np.empty((0, extra.shape[1] if len(extra) else FEATURE_DIM), dtype=np.float32)
+        elif normalized:
+            # Ma trận đã chuẩn hoá (ví dụ np.memmap từ gallery_store) được dùng trực tiếp, không sao chép
+            self._base = matrix
+        else:
+            self._base = normalize_rows(matrix)
+        self._extra = extra
+        self.index = None
+        self.generation = 0
+
+    @classmethod
+    def from_lists(cls, person_ids, person_codes, embeddings):
+        """Tạo gallery từ định dạng cũ: các list song song, mỗi embedding là mảng (1, 128)."""
+        if len(embeddings) == 0:
+            return cls([], [], [])
+        matrix = np.vstack([np.asarray(e, dtype=np.float32).reshape(1, -1) for e in embeddings])
+        return cls(person_ids, person_codes, matrix)
+
+    def __len__(self):
+        return len(self.person_ids)
+
+    @property
+    def matrix(self):
+        """
+        Ma trận đầy đủ (n, d). Khi có hàng extra thì là bản sao ghép hai khối, chỉ dùng cho các thao tác
+        không thường xuyên (ghi store, dựng chỉ mục); chấm điểm dùng _score.
+        """
+        if len(self._extra) == 0:
+            return self._base
+        return np.vstack([self._base, self._extra])
+
+    def _score(self, probes, rows=None):
+        """probes @ matrix[rows].T (rows None: toàn bộ gallery), không ghép ma trận chính với khối extra."""
+        if rows is None:
+            if len(self._extra) == 0:
+                return probes @ self._base.T
+            return np.hstack([probes @ self._base.T, probes @ self._extra.T])
+        base_count = len(self._base)
+        if len(self._extra) == 0 or len(rows) == 0 or rows.max() < base_count:
+            return probes @ self._base[rows].T
+        in_base = rows < base_count
+        scores = np.empty((len(probes), len(rows)), dtype=np.float32)
+        scores[:, in_base] = probes @ self._base[rows[in_base]].T
+        scores[:, ~in_base] = probes @ self._extra[rows[~in_base] - base_count].T
+        return scores
+
+    def scores(self, features):
+        """
+        Chấm điểm một hoặc nhiều probe với toàn bộ gallery.
+        Args:
+            features (ndarray): Đặc trưng (d,), (1, d) hoặc (n, d).
+        Returns:
+            ndarray: Ma trận cosine similarity (n, len(gallery)).
+        """
+        return self._score(normalize_rows(features))
+
+    def set_search(self, mode='exact', options=None):
+        """
+        Chọn cách tìm kiếm:
+            'exact'    chấm điểm toàn bộ gallery,
+            'ivf'      chỉ chấm điểm các cụm gần probe nhất (ann_index.IVFIndex),
+            'centroid' chấm điểm centroid từng người rồi exemplar của shortlist (ann_index.TemplateIndex).
+        Args:
+            options (dict): Tham số chỉ mục, mặc định Config.RECOGNITION.
+        """
+        options = options or Config.RECOGNITION
+        if mode == 'exact' or len(self) == 0:
+            self.index = None
+        elif mode == 'ivf':
+            self.index = IVFIndex.build(self.matrix, nlist=options['ivf_nlist'], nprobe=options['ivf_nprobe'])
+        elif mode == 'centroid':
+            self.index = TemplateIndex.build(self.matrix, self.labels, n_exemplars=options['template_exemplars'],
+                                             shortlist=options['template_shortlist'])
+        else:
+            raise ValueError(f"Unknown gallery search mode: {mode}")
+        return self
+
+    def _scored_candidates(self, probes):
+        """
+        Sinh (scores, rows) cho từng nhóm probe: rows là chỉ số các hàng gallery đã được chấm điểm.
+        Tìm kiếm chính xác chấm điểm cả batch trong một phép nhân ma trận.
+        """
+        if self.index is None:
+            yield self._score(probes), np.arange(len(self))
+            return
+        for probe, rows in zip(probes, self.index.candidates(probes)):
+            yield self._score(probe[np.newaxis, :], rows), rows
+
+    def search_batch(self, features, top_k=1):
+        """
+        Tìm top_k người gần nhất cho từng probe: điểm của mỗi người là điểm cao nhất trong các
+        embedding của người đó, nên một người có nhiều ảnh không chiếm hết top_k.
+        Returns:
+            list: Với mỗi probe, danh sách (person_id, person_code, score) giảm dần theo score,
+                mỗi người tối đa một lần.
+        """
+        probes = normalize_rows(features)
+        if len(self) == 0:
+            return [[] for _ in range(len(probes))]
+
+        # Hàng đầu tiên của mỗi nhãn, để lấy person_id/person_code của người đó
+        first_row = np.unique(self.labels, return_index=True)[1]
+        results = []
+        for scores, rows in self._scored_candidates(probes):
+            # Gom các hàng theo người rồi lấy max từng nhóm: (số probe, số người trong rows)
+            labels = self.labels[rows]
+            by_label = np.argsort(labels, kind='stable')
+            sorted_labels = labels[by_label]
+            starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+            person_scores = np.maximum.reduceat(scores[:, by_label], starts, axis=1)
+            person_labels = sorted_labels[starts]
+
+            k = min(top_k, person_scores.shape[1])
+            if k < person_scores.shape[1]:
+                top = np.argpartition(-person_scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(k), (person_scores.shape[0], k))
+            top_scores = np.take_along_axis(person_scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top = first_row[person_labels[np.take_along_axis(top, order, axis=1)]]
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+            results.extend(
+                [(self.person_ids[idx], self.person_codes[idx], float(score)) for idx, score in zip(row_idx, row_scores)]
+                for row_idx, row_scores in zip(top, top_scores)
+            )
+        return results
+
+    def search(self, feature, top_k=1):
+        """Tìm top_k người gần nhất cho một probe, xem search_batch."""
+        return self.search_batch(feature, top_k)[0]
+
+    def best_match_batch(self, features, threshold, min_margin=0.0):
+        """
+        Tìm ứng viên tốt nhất và ứng viên tốt nhì (của một người khác) cho từng probe,
+        trong một lần duyệt vector hoá gallery. Kết quả không phụ thuộc thứ tự gallery.
+        Args:
+            features (ndarray): Đặc trưng (d,), (1, d) hoặc (n, d).
+            threshold (float): Điểm tối thiểu để chấp nhận.
+            min_margin (float): Khoảng cách tối thiểu giữa ứng viên tốt nhất và tốt nhì.
+        Returns:
+            list: MatchResult cho từng probe, hoặc None nếu gallery rỗng.
+        """
+        probes = normalize_rows(features)
+        if len(self) == 0:
+            return [None] * len(probes)
+
+        results = []
+        for scores, rows in self._scored_candidates(probes):
+            results.extend(self._best_of(scores, rows, threshold, min_margin))
+        return results
+
+    def _best_of(self, scores, rows, threshold, min_margin):
+        probe_rows = np.arange(len(scores))
+        best = scores.argmax(axis=1)
+        best_scores = scores[probe_rows, best]
+
+        # Loại các hàng cùng người với ứng viên tốt nhất rồi lấy max phần còn lại
+        labels = self.labels[rows]
+        same_person = labels[np.newaxis, :] == labels[best][:, np.newaxis]
+        others = np.where(same_person, -np.inf, scores)
+        runner = others.argmax(axis=1)
+        runner_scores = others[probe_rows, runner]
+
+        results = []
+        for b, score, r, runner_score in zip(rows[best], best_scores, rows[runner], runner_scores):
+            if np.isfinite(runner_score):
+                runner_id, runner_code, runner_score = self.person_ids[r], self.person_codes[r], float(runner_score)
+                margin = float(score) - runner_score
+            else:
+                runner_id, runner_code, runner_score = None, None, None
+                margin = float('inf')
+            results.append(MatchResult(
+                index=int(b),
+                person_id=self.person_ids[b],
+                person_code=self.person_codes[b],
+                score=float(score),
+                runner_up_id=runner_id,
+                runner_up_code=runner_code,
+                runner_up_score=runner_score,
+                margin=margin,
+                accepted=bool(score >= threshold and margin >= min_margin),
+            ))
+        return results
+
+    def best_match(self, feature, threshold, min_margin=0.0):
+        """Tìm ứng viên tốt nhất cho một probe, xem best_match_batch."""
+        return self.best_match_batch(feature, threshold, min_margin)[0]
+
+
+def load_gallery(path, search=None):
+    """
+    Đọc gallery từ thư mục gallery (xem gallery_store) hoặc từ file embeddings.pkl cũ
+    (person_ids, person_codes, embeddings). Đường dẫn chưa tồn tại được coi là thư mục gallery:
+    gallery mặc định được tạo từ embeddings.pkl cũ nếu có, còn lại cho ra gallery rỗng.
+    Cách tìm kiếm mặc định là Config.RECOGNITION['search'], xem Gallery.set_search.
+    """
+    search = search or Config.RECOGNITION['search']
+
+    if not os.path.isfile(path):
+        from app.utils.gallery_store import open_gallery_store
+        gallery = open_gallery_store(path)
+    else:
+        gallery = _load_pickle(path)
+    gallery.set_search(search)
+    logger.info(f"Loaded gallery from {path}: {len(gallery)} entries, search={search}")
+    return gallery
+
+
+def _load_pickle(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        logger.warning(f"Embeddings file {path} is missing or empty. Using an empty gallery.")
+        return Gallery([], [], [])
+
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    if not isinstance(data, (tuple, list)) or len(data) != 3:
+        raise ValueError(f"Invalid data format in {path}")
+
+    person_ids, person_codes, embeddings = data
+    count = min(len(person_ids), len(person_codes), len(embeddings))
+    if not (len(person_ids) == len(person_codes) == len(embeddings)):
+        logger.warning(f"Mismatched list lengths in {path}: {len(person_ids)} ids, {len(person_codes)} codes, "
+                       f"{len(embeddings)} embeddings. Keeping the first {count} entries.")
+    return Gallery.from_lists(person_ids[:count], person_codes[:count], embeddings[:count])
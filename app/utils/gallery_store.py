@@ -0,0 +1,447 @@
+import os
+import sys
+import zlib
+import struct
+import logging
+import threading
+import numpy as np
+from app.config import Config
+from app.utils.gallery import Gallery, normalize_rows, load_gallery
+
+logger = logging.getLogger(__name__)
+
+# Thư mục gallery:
+#   CURRENT               tên file dữ liệu đang dùng (thay thế nguyên tử bằng os.replace)
+#   gallery-000001.bin    header cố định + ma trận float32 + bảng person_id/person_code
+#   gallery-000001.log    các embedding thêm sau (append-only) của generation 1
+#   gallery-000001.log.meta  (số bản ghi, số byte hợp lệ) của log, để append không phải đọc lại cả log
+#   LOCK                  khoá ghi giữa các process
+# Mỗi lần ghi toàn bộ tạo một file dữ liệu mới với generation tăng dần rồi trỏ CURRENT sang nó,
+# nên reader đang memmap file cũ không bị ảnh hưởng (kể cả trên Windows, nơi không thể
+# ghi đè một file đang được map). add_face chỉ nối một bản ghi vào file log; khi log đủ dài
+# thì được gộp (compact) vào một file dữ liệu mới.
+MAGIC = b'FGAL'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQQQQ')  # magic, version, dim, code_width, count, generation, ids_offset, codes_offset
+HEADER_SIZE = 64
+CURRENT_FILE = 'CURRENT'
+LOCK_FILE = 'LOCK'
+# Bản ghi log: (độ dài payload, crc32 payload) + payload (person_id, độ dài code, code, đặc trưng float32).
+# Bản ghi ghi dở (process chết giữa chừng) bị phát hiện nhờ độ dài/crc và bị bỏ qua.
+LOG_PREFIX = struct.Struct('<II')
+LOG_ENTRY = struct.Struct('<qH')
+LOG_META = struct.Struct('<QQ')
+
+
+def _data_file_name(generation):
+    return f"gallery-{generation:06d}.bin"
+
+
+def _log_file_name(generation):
+    return f"gallery-{generation:06d}.log"
+
+
+def _log_meta_name(generation):
+    return _log_file_name(generation) + '.meta'
+
+
+class _StoreLock:
+    """Khoá ghi độc quyền trên thư mục gallery, dùng được giữa nhiều process."""
+
+    def __init__(self, store_dir):
+        self.path = os.path.join(store_dir, LOCK_FILE)
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a+b')
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    self.file.seek(0)
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if os.name == 'nt':
+            import msvcrt
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _align(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def read_current(store_dir):
+    """
+    Đọc CURRENT của thư mục gallery.
+    Returns:
+        tuple: (generation, đường dẫn file dữ liệu), hoặc (0, None) nếu chưa có gallery.
+    """
+    try:
+        with open(os.path.join(store_dir, CURRENT_FILE), 'r') as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return 0, None
+    generation = int(name[len('gallery-'):-len('.bin')])
+    return generation, os.path.join(store_dir, name)
+
+
+def store_entry_count(store_dir):
+    """Tổng số embedding hiện có trong store (file dữ liệu + log)."""
+    return len(open_gallery_store(store_dir))
+
+
+def write_gallery_store(store_dir, gallery, replay_from=None):
+    """
+    Ghi toàn bộ gallery thành một file dữ liệu mới và chuyển CURRENT sang nó (rebuild đầy đủ).
+    Args:
+        replay_from (int): Số embedding của store lúc bắt đầu rebuild (store_entry_count). Store chỉ
+            được nối thêm (append/compact giữ thứ tự), nên các embedding từ vị trí này trở đi là do
+            add_face thêm trong lúc rebuild; chúng được nối vào gallery mới thay vì mất cùng log cũ.
+    Returns:
+        int: generation của file vừa ghi.
+    """
+    with _StoreLock(store_dir):
+        if replay_from is not None:
+            current = open_gallery_store(store_dir, migrate=False)
+            if len(current) > replay_from:
+                logger.info(f"Replaying {len(current) - replay_from} entries appended during the rebuild")
+                gallery = Gallery(
+                    gallery.person_ids + current.person_ids[replay_from:],
+                    gallery.person_codes + current.person_codes[replay_from:],
+                    np.vstack([gallery.matrix, current.matrix[replay_from:]]),
+                    normalized=True,
+                )
+        return _write_locked(store_dir, gallery)
+
+
+def _write_locked(store_dir, gallery):
+    generation = read_current(store_dir)[0] + 1
+
+    count, dim = gallery.matrix.shape
+    ids = np.asarray(gallery.person_ids, dtype=np.int64)
+    codes = np.array([str(c).encode('utf-8') for c in gallery.person_codes], dtype=np.bytes_)
+    code_width = max(codes.dtype.itemsize, 1)
+    codes = codes.astype(f'S{code_width}')
+
+    ids_offset = _align(HEADER_SIZE + count * dim * 4)
+    codes_offset = ids_offset + count * 8
+
+    data_path = os.path.join(store_dir, _data_file_name(generation))
+    tmp_path = data_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        header = HEADER.pack(MAGIC, VERSION, dim, code_width, count, generation, ids_offset, codes_offset)
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.write(np.ascontiguousarray(gallery.matrix, dtype='<f4').tobytes())
+        f.write(b'\0' * (ids_offset - f.tell()))
+        f.write(ids.astype('<i8').tobytes())
+        f.write(codes.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, data_path)
+
+    current_tmp = os.path.join(store_dir, CURRENT_FILE + '.tmp')
+    with open(current_tmp, 'w') as f:
+        f.write(_data_file_name(generation))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(current_tmp, os.path.join(store_dir, CURRENT_FILE))
+    logger.info(f"Wrote gallery store {data_path}: {count} entries")
+
+    _remove_stale_files(store_dir, generation)
+    return generation
+
+
+def _legacy_pickle(store_dir):
+    """File embeddings.pkl cũ (Config.PATHS['embeddings']) cần chuyển sang store, chỉ với store mặc định."""
+    legacy = Config.PATHS['embeddings']
+    if os.path.abspath(store_dir) != os.path.abspath(Config.PATHS['gallery']) or not os.path.isfile(legacy):
+        return None
+    return legacy
+
+
+def _create_locked(store_dir):
+    """
+    Tạo generation đầu tiên của store chưa có CURRENT: chuyển từ embeddings.pkl cũ nếu có
+    (triển khai đang chạy không mất gallery khi nâng cấp), không thì tạo gallery rỗng.
+    """
+    legacy = _legacy_pickle(store_dir)
+    gallery = load_gallery(legacy, search='exact') if legacy else Gallery([], [], [])
+    generation = _write_locked(store_dir, gallery)
+    if legacy:
+        logger.info(f"Migrated {len(gallery)} embeddings from {legacy} to gallery store {store_dir}")
+    return generation
+
+
+def _remove_stale_files(store_dir, generation):
+    """Xoá file dữ liệu/log cũ; file đang được process khác map (Windows) sẽ được xoá lần sau."""
+    keep = (_data_file_name(generation), _log_file_name(generation), _log_meta_name(generation))
+    for name in os.listdir(store_dir):
+        if name.startswith('gallery-') and name.endswith(('.bin', '.log', '.meta')) and name not in keep:
+            try:
+                os.remove(os.path.join(store_dir, name))
+            except OSError:
+                pass
+
+
+def _read_log(log_path, start=0):
+    """
+    Đọc các bản ghi hợp lệ của log, bắt đầu từ byte start (ranh giới một bản ghi).
+    Returns:
+        tuple: (person_ids, person_codes, features, số byte hợp lệ tính từ đầu log)
+    """
+    person_ids, person_codes, features = [], [], []
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+    except FileNotFoundError:
+        return person_ids, person_codes, features, 0
+
+    offset = 0
+    while offset + LOG_PREFIX.size <= len(data):
+        length, crc = LOG_PREFIX.unpack_from(data, offset)
+        payload = data[offset + LOG_PREFIX.size:offset + LOG_PREFIX.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        person_id, code_len = LOG_ENTRY.unpack_from(payload)
+        code = payload[LOG_ENTRY.size:LOG_ENTRY.size + code_len].decode('utf-8')
+        person_ids.append(person_id)
+        person_codes.append(code)
+        features.append(np.frombuffer(payload, dtype='<f4', offset=LOG_ENTRY.size + code_len))
+        offset += LOG_PREFIX.size + length
+    return person_ids, person_codes, features, start + offset
+
+
+def _read_log_meta(meta_path):
+    try:
+        with open(meta_path, 'rb') as f:
+            return LOG_META.unpack(f.read(LOG_META.size))
+    except (FileNotFoundError, struct.error):
+        return 0, 0
+
+
+def _write_log_meta(meta_path, count, valid_size):
+    with open(meta_path, 'wb') as f:
+        f.write(LOG_META.pack(count, valid_size))
+
+
+def open_gallery_store(store_dir, migrate=True):
+    """
+    Mở gallery bằng np.memmap: ma trận không được đọc vào bộ nhớ riêng của process
+    mà dùng chung page cache giữa các camera worker; chỉ bảng id/code nhỏ được giải mã.
+    Các bản ghi trong log là khối extra riêng của Gallery, ma trận memmap không bị sao chép.
+    Args:
+        migrate (bool): Store mặc định chưa có CURRENT thì tạo từ embeddings.pkl cũ (xem _create_locked).
+            False khi người gọi đang giữ khoá của store.
+    """
+    for _ in range(3):
+        generation, data_path = read_current(store_dir)
+        if data_path is None and migrate and _legacy_pickle(store_dir):
+            with _StoreLock(store_dir):
+                if read_current(store_dir)[1] is None:
+                    _create_locked(store_dir)
+            continue
+        if data_path is None:
+            logger.warning(f"Gallery store {store_dir} has no data. Using an empty gallery.")
+            return Gallery([], [], [])
+        try:
+            gallery = _open_data_file(data_path)
+        except FileNotFoundError:
+            # Bị compact/rebuild chen ngang giữa lúc đọc CURRENT và mở file: đọc lại CURRENT
+            continue
+        log_ids, log_codes, log_features, _ = _read_log(os.path.join(store_dir, _log_file_name(generation)))
+        if read_current(store_dir)[0] != generation:
+            continue
+        break
+    else:
+        raise RuntimeError(f"Gallery store {store_dir} kept changing while being opened")
+
+    if log_ids:
+        gallery = Gallery(gallery.person_ids + log_ids, gallery.person_codes + log_codes, gallery.matrix,
+                          normalized=True, extra=log_features)
+    gallery.generation = generation
+    return gallery
+
+
+def _open_data_file(data_path):
+    with open(data_path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    magic, version, dim, code_width, count, _, ids_offset, codes_offset = HEADER.unpack_from(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Invalid gallery store file {data_path}")
+    if count == 0:
+        return Gallery([], [], [])
+
+    matrix = np.memmap(data_path, dtype='<f4', mode='r', offset=HEADER_SIZE, shape=(count, dim))
+    ids = np.memmap(data_path, dtype='<i8', mode='r', offset=ids_offset, shape=(count,))
+    codes = np.memmap(data_path, dtype=f'S{code_width}', mode='r', offset=codes_offset, shape=(count,))
+    return Gallery(ids.tolist(), np.char.decode(codes, 'utf-8').tolist(), matrix, normalized=True)
+
+
+def append_entry(store_dir, person_id, person_code, feature, compact_threshold=None):
+    """
+    Nối một embedding vào log của generation hiện tại: O(1) I/O, không ghi lại cả gallery.
+    Số bản ghi và số byte hợp lệ của log được giữ trong file .meta; chỉ phần log sau đó
+    (bản ghi của lần ghi bị gián đoạn trước khi cập nhật .meta) phải đọc lại.
+    Khi log vượt compact_threshold bản ghi (mặc định Config.GALLERY['compact_threshold'])
+    thì gộp vào một file dữ liệu mới.
+    Returns:
+        int: generation hiện tại sau khi ghi.
+    """
+    if compact_threshold is None:
+        compact_threshold = Config.GALLERY['compact_threshold']
+
+    code = str(person_code).encode('utf-8')
+    vector = normalize_rows(feature)[0].astype('<f4')
+    payload = LOG_ENTRY.pack(int(person_id), len(code)) + code + vector.tobytes()
+    record = LOG_PREFIX.pack(len(payload), zlib.crc32(payload)) + payload
+
+    with _StoreLock(store_dir):
+        generation, data_path = read_current(store_dir)
+        if data_path is None:
+            generation = _create_locked(store_dir)
+
+        log_path = os.path.join(store_dir, _log_file_name(generation))
+        meta_path = os.path.join(store_dir, _log_meta_name(generation))
+        count, valid_size = _read_log_meta(meta_path)
+        try:
+            log_size = os.path.getsize(log_path)
+        except FileNotFoundError:
+            log_size = 0
+        if log_size < valid_size:
+            # .meta không khớp log (không nên xảy ra): đếm lại từ đầu
+            count, valid_size = 0, 0
+        if log_size > valid_size:
+            tail_ids, _, _, valid_size = _read_log(log_path, valid_size)
+            count += len(tail_ids)
+        with open(log_path, 'ab') as f:
+            # Cắt bỏ bản ghi ghi dở do lần ghi trước bị gián đoạn
+            if f.tell() > valid_size:
+                f.truncate(valid_size)
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        count += 1
+        _write_log_meta(meta_path, count, valid_size + len(record))
+
+        if count >= compact_threshold:
+            generation = _compact_locked(store_dir)
+    return generation
+
+
+def compact_store(store_dir):
+    """Gộp log vào một file dữ liệu mới. Returns: generation mới."""
+    with _StoreLock(store_dir):
+        return _compact_locked(store_dir)
+
+
+def _compact_locked(store_dir):
+    gallery = open_gallery_store(store_dir, migrate=False)
+    generation = _write_locked(store_dir, gallery)
+    logger.info(f"Compacted gallery store {store_dir}: {len(gallery)} entries, generation {generation}")
+    return generation
+
+
+def store_version(path):
+    """
+    Phiên bản hiện tại của gallery, thay đổi mỗi khi gallery được ghi: (generation, kích thước log)
+    với thư mục gallery, (mtime, kích thước) với file embeddings.pkl cũ. Chỉ tốn vài lần stat.
+    """
+    if os.path.isdir(path):
+        generation, _ = read_current(path)
+        try:
+            log_size = os.stat(os.path.join(path, _log_file_name(generation))).st_size
+        except FileNotFoundError:
+            log_size = 0
+        return generation, log_size
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return 0, 0
+
+
+class GalleryWatcher:
+    """
+    Giữ gallery hiện tại và tải lại trong thread nền, một lần cho mỗi thay đổi của store_version.
+    Vòng lặp xử lý khung hình chỉ đọc watcher.gallery: phép gán tham chiếu là nguyên tử nên
+    không bao giờ thấy gallery dở dang và không bị chặn trong lúc tải lại.
+    """
+
+    def __init__(self, path, interval=None, search=None):
+        self.path = path
+        self.interval = Config.GALLERY['reload_interval'] if interval is None else interval
+        self.search = search
+        self.version = store_version(path)
+        self.gallery = load_gallery(path, search)
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='gallery-watcher', daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        """Kiểm tra thay đổi ngay, không chờ hết interval."""
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                return
+            version = store_version(self.path)
+            if version == self.version:
+                continue
+            try:
+                gallery = load_gallery(self.path, self.search)
+            except Exception as e:
+                logger.error(f"Error reloading gallery {self.path}: {str(e)}")
+                continue
+            self.version = version
+            self.gallery = gallery
+            logger.info(f"Reloaded gallery {self.path}: {len(gallery)} entries, version {version}")
+
+
+if __name__ == '__main__':
+    # python -m app.utils.gallery_store convert [embeddings.pkl] [gallery_dir]   (chỉ với store rỗng)
+    # python -m app.utils.gallery_store compact [gallery_dir]
+    from app.utils.gallery import load_gallery
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'convert'
+    if command == 'convert':
+        source = sys.argv[2] if len(sys.argv) > 2 else Config.PATHS['embeddings']
+        target = sys.argv[3] if len(sys.argv) > 3 else Config.PATHS['gallery']
+        # Ghi đè store đang có sẽ mất các khuôn mặt add_face đã thêm: chỉ chuyển vào store rỗng
+        existing = len(open_gallery_store(target, migrate=False))
+        if existing:
+            print(f"Gallery store {target} already has {existing} entries. "
+                  f"Use python -m app.utils.rebuild_gallery to rebuild it from the database.")
+            sys.exit(1)
+        # replay_from=0: khuôn mặt add_face thêm sau lần kiểm tra trên vẫn được giữ
+        generation = write_gallery_store(target, load_gallery(source, search='exact'), replay_from=0)
+        print(f"Converted {source} -> {target} (generation {generation})")
+    elif command == 'compact':
+        target = sys.argv[2] if len(sys.argv) > 2 else Config.PATHS['gallery']
+        print(f"Compacted {target} (generation {compact_store(target)})")
+    else:
+        print(f"Unknown command: {command}")
+        sys.exit(1)
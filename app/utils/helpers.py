@@ -4,7 +4,7 @@ import cv2
 import os
 from datetime import datetime
 from flask import request, jsonify
-import subprocess
+from app.utils.faceRecognise import recognise_frame
 
 def process_image(image_base64, output_dir='timekeepings'):
     try:
@@ -30,34 +30,20 @@ def process_image(image_base64, output_dir='timekeepings'):
         # Lưu ảnh
         cv2.imwrite(filename, image)
         
+        # Nhận diện trong process bằng mô hình và gallery thường trú
         try:
-            result = subprocess.run(
-                ['python', 'faceRecognise.py', filename], 
-                capture_output=True, 
-                text=True, 
-                timeout=30
-            )
-            
-            # Phân tích kết quả từ subprocess
-            if result.returncode == 0:
-                # Nếu thành công
+            success, message = recognise_frame(image, os.path.basename(filename))
+            if success:
                 return jsonify({
                     "status": "success", 
-                    "message": result.stdout.strip(),
+                    "message": message,
                     "file": filename
                 }), 200
             else:
-                # Nếu có lỗi
                 return jsonify({
                     "status": "error", 
-                    "message": result.stderr.strip()
+                    "message": message
                 }), 500
-
-        except subprocess.TimeoutExpired:
-            return jsonify({
-                "status": "error", 
-                "message": "Quá trình nhận diện mất quá nhiều thời gian"
-            }), 504
         except Exception as e:
             return jsonify({
                 "status": "error", 
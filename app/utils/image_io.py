@@ -0,0 +1,60 @@
+import os
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# Một thread ghi file ảnh bằng chứng ở nền, không chặn request
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='evidence-writer')
+
+
+def decode_image(image_bytes):
+    """
+    Giải mã ảnh (JPEG, PNG, ...) trực tiếp từ bytes trong bộ nhớ.
+    Returns:
+        ndarray: Ảnh BGR, hoặc None nếu không giải mã được.
+    """
+    if not image_bytes:
+        return None
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+
+def image_extension(image_bytes):
+    """Đuôi file theo định dạng thật của ảnh, để lưu nguyên bytes mà không mã hoá lại."""
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n':
+        return '.png'
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return '.webp'
+    return '.jpg'
+
+
+def evidence_filename(image_bytes):
+    """Tên file ảnh chấm công theo thời điểm nhận (tới micro giây để không trùng giữa các request)."""
+    return f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{image_extension(image_bytes)}"
+
+
+def save_image_async(image_bytes, save_dir, filename):
+    """
+    Ghi nguyên bytes ảnh vào save_dir/filename ở nền: ghi file tạm rồi os.replace,
+    nên không ai đọc được file ghi dở.
+    Returns:
+        Future: Kết quả là đường dẫn file đã lưu.
+    """
+    return _writer.submit(_save_image, image_bytes, save_dir, filename)
+
+
+def _save_image(image_bytes, save_dir, filename):
+    save_path = os.path.join(save_dir, filename)
+    try:
+        os.makedirs(save_dir, exist_ok=True)
+        tmp_path = save_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, save_path)
+        return save_path
+    except Exception as e:
+        logger.error(f"Error saving image {save_path}: {str(e)}")
+        raise
@@ -0,0 +1,110 @@
+import time
+import numpy as np
+import cv2
+from app.config import Config
+
+
+def _parse_region(spec):
+    x0, y0, x1, y1 = (float(v) for v in spec.split(','))
+    return x0, y0, x1, y1
+
+
+def motion_region(camera_id=None):
+    """
+    Vùng đo chuyển động của camera (x0, y0, x1, y1, theo tỉ lệ 0..1 của khung hình): lấy từ
+    Config.CAMERA['motion_regions'] ('camera_id:x0,y0,x1,y1;...') nếu có, không thì motion_region.
+    """
+    for item in Config.CAMERA['motion_regions'].split(';'):
+        if ':' not in item:
+            continue
+        key, spec = item.split(':', 1)
+        if camera_id is not None and key.strip() == str(camera_id):
+            return _parse_region(spec)
+    return _parse_region(Config.CAMERA['motion_region'])
+
+
+class MotionDetector:
+    """
+    Đo chuyển động bằng hiệu hai khung hình liên tiếp trên ảnh xám thu nhỏ (rộng width pixel).
+    Rất rẻ so với YuNet: một lần resize INTER_AREA, một lần absdiff trên vài nghìn pixel.
+    """
+
+    def __init__(self, width=None, pixel_delta=None):
+        self.width = width or Config.CAMERA['motion_width']
+        self.pixel_delta = pixel_delta or Config.CAMERA['motion_pixel_delta']
+        self._previous = None
+
+    def reset(self):
+        """Quên khung hình trước, ví dụ sau một khoảng không xử lý."""
+        self._previous = None
+
+    def _prepare(self, frame):
+        h, w = frame.shape[:2]
+        size = (self.width, max(1, int(h * self.width / w)))
+        grey = cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(grey, (3, 3), 0)
+
+    def changed_fraction(self, frame, exclude=None):
+        """
+        Tỉ lệ pixel thay đổi quá pixel_delta so với khung hình trước.
+        Args:
+            exclude (list): Các box [x, y, w, h] (theo kích thước frame) bỏ qua khi đo, ví dụ
+                khuôn mặt đang được theo dõi.
+        Returns:
+            float: 0..1, bằng 0 ở khung hình đầu tiên.
+        """
+        grey = self._prepare(frame)
+        previous, self._previous = self._previous, grey
+        if previous is None or previous.shape != grey.shape:
+            return 0.0
+        changed = cv2.absdiff(grey, previous) > self.pixel_delta
+        if exclude:
+            scale = grey.shape[1] / frame.shape[1]
+            for x, y, w, h in exclude:
+                x0, y0 = max(0, int(x * scale)), max(0, int(y * scale))
+                changed[y0:int((y + h) * scale) + 1, x0:int((x + w) * scale) + 1] = False
+        return float(np.count_nonzero(changed)) / changed.size
+
+
+class MotionGate:
+    """
+    Cổng chuyển động đặt trước bước phát hiện: camera không có chuyển động trong vùng region thì
+    không resize, không chạy YuNet/tracker. Mở ngay ở khung hình đầu tiên có chuyển động và giữ mở
+    thêm hold giây sau chuyển động cuối cùng (người đứng yên trước camera vẫn được nhận diện).
+    duty_cycle là tỉ lệ khung hình được xử lý đầy đủ.
+    """
+
+    def __init__(self, region=None, threshold=None, hold=None, detector=None):
+        self.region = region or motion_region()
+        self.threshold = Config.CAMERA['motion_gate_threshold'] if threshold is None else threshold
+        self.hold = Config.CAMERA['motion_hold'] if hold is None else hold
+        self.detector = detector or MotionDetector()
+        # Xử lý đầy đủ trong hold giây đầu, để người đã đứng sẵn trước camera vẫn được nhận diện
+        self.active_until = time.monotonic() + self.hold
+        self.frames = 0
+        self.active_frames = 0
+
+    def _crop(self, frame):
+        h, w = frame.shape[:2]
+        x0, y0, x1, y1 = self.region
+        return frame[int(y0 * h):max(int(y1 * h), int(y0 * h) + 1), int(x0 * w):max(int(x1 * w), int(x0 * w) + 1)]
+
+    def update(self, frame):
+        """
+        Returns:
+            bool: True nếu khung hình này cần xử lý đầy đủ.
+        """
+        now = time.monotonic()
+        if self.detector.changed_fraction(self._crop(frame)) > self.threshold:
+            self.active_until = now + self.hold
+        active = now < self.active_until
+        self.frames += 1
+        self.active_frames += active
+        return active
+
+    @property
+    def duty_cycle(self):
+        return self.active_frames / self.frames if self.frames else 0.0
+
+    def stats(self):
+        return {'frames': self.frames, 'active_frames': self.active_frames, 'duty_cycle': round(self.duty_cycle, 3)}
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import logging
+import multiprocessing
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from MySQLConnector import getConnector
+from app.config import Config
+from app.utils.gallery import Gallery
+from app.utils.gallery_store import write_gallery_store, store_entry_count
+from app.utils.embedding_cache import EmbeddingCache, file_hash
+
+logger = logging.getLogger(__name__)
+
+# Mô hình của từng process con trong pool, tạo một lần bởi _init_worker
+_face_detector = None
+_sface_model = None
+
+
+def _init_worker(yunet_path, sface_path):
+    global _face_detector, _sface_model
+    cv2.setNumThreads(1)  # Song song theo process, tránh mỗi process lại chiếm hết core
+    _face_detector = cv2.FaceDetectorYN.create(yunet_path, "", (640, 480))
+    _sface_model = cv2.FaceRecognizerSF.create(sface_path, "")
+
+
+def _embed_image(image_hash, img_path):
+    """
+    Chạy YuNet + SFace trên một ảnh đăng ký.
+    Returns:
+        tuple: (image_hash, img_path, đặc trưng (n, 128)), đặc trưng là None nếu không đọc được ảnh.
+    """
+    img = cv2.imread(img_path)
+    if img is None:
+        return image_hash, img_path, None
+
+    h, w = img.shape[:2]
+    _face_detector.setInputSize((w, h))
+    faces = _face_detector.detect(img)[1]
+    if faces is None:
+        return image_hash, img_path, np.empty((0, 128), dtype=np.float32)
+
+    features = [_sface_model.feature(_sface_model.alignCrop(img, face)) for face in faces]
+    return image_hash, img_path, np.vstack(features)
+
+
+def rebuild_gallery(workers=None, progress_every=50, image_dir=None):
+    """
+    Tạo lại toàn bộ gallery từ bảng image.
+    Ảnh được băm theo nội dung; ảnh đã có trong cache embedding được bỏ qua, phần còn lại được
+    chia cho một process pool. Mỗi kết quả được lưu vào cache ngay khi xong nên nếu bị gián đoạn,
+    lần chạy sau chỉ xử lý những ảnh còn thiếu.
+    Chỉ gọi từ entry point có bảo vệ `if __name__ == '__main__':` (hoặc trong request handler):
+    trên Windows process con được spawn và import lại module chính.
+    Args:
+        workers (int): Số process, mặc định Config.GALLERY['rebuild_workers'] (0: số core).
+        progress_every (int): Ghi log tiến độ sau mỗi chừng này ảnh.
+        image_dir (str): Thư mục chứa ảnh khuôn mặt, mặc định Config.PATHS['faces'].
+    Returns:
+        dict: Thống kê số ảnh, số ảnh lấy từ cache, số ảnh phải xử lý, số embeddings.
+    """
+    started = time.perf_counter()
+    workers = workers or Config.GALLERY['rebuild_workers'] or os.cpu_count()
+    image_dir = image_dir or Config.PATHS['faces']
+
+    # Các embedding add_face thêm sau thời điểm này được giữ lại khi ghi gallery mới
+    start_count = store_entry_count(Config.PATHS['gallery'])
+
+    conn = getConnector()
+    cursor = conn.cursor()
+    cursor.execute("SELECT image.link, person.id, person.code FROM image INNER JOIN person ON image.personcode = person.code")
+    list_img = cursor.fetchall()
+    cursor.close()
+    conn.close()
+
+    with EmbeddingCache.open_default() as cache:
+        entries = []
+        pending = {}
+        for filename, person_id, person_code in list_img:
+            if not filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                continue
+            img_path = os.path.join(image_dir, filename)
+            try:
+                image_hash = file_hash(img_path)
+            except OSError as e:
+                logger.warning(f"Cannot read image {img_path}: {str(e)}")
+                continue
+            entries.append((image_hash, person_id, person_code))
+            if image_hash not in pending and cache.get(image_hash) is None:
+                pending[image_hash] = img_path
+
+        logger.info(f"Rebuilding gallery: {len(entries)} images, {len(entries) - len(pending)} cached, "
+                    f"{len(pending)} to embed with {workers} workers")
+
+        if pending:
+            # spawn cả trên Linux: rebuild có thể chạy từ một thread của server đa luồng (app.py), fork
+            # lúc đó có thể sao chép khoá OpenCV/OpenMP đang bị giữ và làm process con treo
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=_init_worker,
+                                     initargs=(Config.PATHS['yunet'], Config.PATHS['sface'])) as pool:
+                futures = [pool.submit(_embed_image, image_hash, img_path) for image_hash, img_path in pending.items()]
+                for done, future in enumerate(as_completed(futures), 1):
+                    try:
+                        image_hash, img_path, features = future.result()
+                        if features is None:
+                            logger.warning(f"Cannot read image {img_path}")
+                        else:
+                            cache.put(image_hash, features)
+                    except Exception as e:
+                        logger.error(f"Error embedding image: {str(e)}")
+                    if done % progress_every == 0 or done == len(futures):
+                        logger.info(f"Embedded {done}/{len(futures)} images")
+
+        person_ids = []
+        person_codes = []
+        embeddings = []
+        for image_hash, person_id, person_code in entries:
+            features = cache.get(image_hash)
+            if features is None:
+                continue
+            for feature in features:
+                person_ids.append(person_id)
+                person_codes.append(person_code)
+                embeddings.append(feature)
+
+    write_gallery_store(Config.PATHS['gallery'], Gallery.from_lists(person_ids, person_codes, embeddings),
+                        replay_from=start_count)
+    stats = {
+        'images': len(entries),
+        'cached': len(entries) - len(pending),
+        'embedded': len(pending),
+        'embeddings': len(embeddings),
+        'seconds': time.perf_counter() - started,
+    }
+    logger.info(f"Gallery rebuilt: {stats}")
+    return stats
+
+
+if __name__ == '__main__':
+    # python -m app.utils.rebuild_gallery [workers]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    rebuild_gallery(int(sys.argv[1]) if len(sys.argv) > 1 else None)
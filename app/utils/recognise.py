@@ -1,14 +1,24 @@
 import cv2
-import pickle
 import numpy as np
 import logging
 from app.config import Config
+from app.utils.face_service import get_face_service
 import os
 
-def cosine_similarity(vec1, vec2):
-    return float(np.dot(vec1, vec2.T) / (np.linalg.norm(vec1) * np.linalg.norm(vec2)))
+# Toạ độ 5 điểm mốc (mắt phải, mắt trái, mũi, khoé miệng phải, khoé miệng trái) trên ảnh 112x112
+# mà FaceRecognizerSF.alignCrop căn chỉnh khuôn mặt về
+SFACE_REFERENCE_LANDMARKS = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041],
+], dtype=np.float32)
 
-def match_face_embedding(file_name, threshold=0.4):
+# Số pixel viền thêm quanh ảnh 112x112 trước khi chạy YuNet để kiểm tra
+CROP_DETECTION_PADDING = 32
+
+def match_face_embedding(file_name, threshold=0.4, min_margin=Config.RECOGNITION['min_margin']):
     file_path = os.path.join(Config.PATHS['timekeepings'], file_name)
     print(file_path)
     try:
@@ -17,52 +27,126 @@ def match_face_embedding(file_name, threshold=0.4):
         if frame is None:
             logging.error(f"Cannot read image: {file_path}")
             return None
+        return match_face_frame(frame, threshold, min_margin, source=file_path)
+    except TimeoutError:
+        # Quá tải: để route trả về 503 thay vì coi như không nhận diện được
+        raise
+    except Exception as e:
+        logging.error(f"Error in match_face_embedding: {str(e)}")
+        return None
 
+def match_face_frame(frame, threshold=0.4, min_margin=Config.RECOGNITION['min_margin'], source='frame'):
+    """
+    Nhận diện khuôn mặt duy nhất trong một ảnh đã giải mã (ndarray BGR), không đọc ghi file.
+    Returns:
+        tuple: (person_id, person_code, score), hoặc None nếu không nhận diện được.
+    """
+    try:
         # Resize nếu cần
         h, w = frame.shape[:2]
         if w > 1280 or h > 720:
             scale = min(1280 / w, 720 / h)
             frame = cv2.resize(frame, (int(w * scale), int(h * scale)))
 
-        # Thiết lập kích thước cho detector
-        face_detector = cv2.FaceDetectorYN.create(Config.PATHS['yunet'], "", (640, 480))
-        sface_model = cv2.FaceRecognizerSF.create(Config.PATHS['sface'], "")
-        face_detector.setInputSize((frame.shape[1], frame.shape[0]))
+        # Mô hình và gallery dùng chung, chỉ tải một lần cho cả process
+        service = get_face_service()
 
         # Phát hiện khuôn mặt
-        faces = face_detector.detect(frame)
-        if faces[1] is None or len(faces[1]) == 0:
-            logging.warning(f"No face detected in image: {file_path}")
+        faces = service.detect(frame)
+        if len(faces) == 0:
+            logging.warning(f"No face detected in image: {source}")
             return None
-        if len(faces[1]) > 1:
-            logging.warning(f"Multiple faces detected in image: {file_path}. Only one expected.")
+        if len(faces) > 1:
+            logging.warning(f"Multiple faces detected in image: {source}. Only one expected.")
+            return None
+
+        # Căn chỉnh khuôn mặt, rồi trích xuất đặc trưng và so khớp với toàn bộ gallery
+        # (gom batch với các request đồng thời), lấy ứng viên tốt nhất và khoảng cách tới ứng viên tốt nhì
+        aligned_face = service.align(frame, faces[0])
+        match = service.match_aligned(aligned_face, threshold, min_margin)
+        if match is None:
+            logging.info("No matching face. Gallery is empty")
+            return None
+
+        if match.accepted:
+            logging.info(f"Match found: person_code={match.person_code}, score={match.score:.4f}, margin={match.margin:.4f}")
+            return match.person_id, match.person_code, match.score
+        else:
+            logging.info(f"No matching face. Best score: {match.score:.4f}, margin: {match.margin:.4f}")
             return None
+    except TimeoutError:
+        # Quá tải: để route trả về 503 thay vì coi như không nhận diện được
+        raise
+    except Exception as e:
+        logging.error(f"Error in match_face_frame: {str(e)}")
+        return None
 
-        # Trích xuất đặc trưng
-        face = faces[1][0]
-        aligned_face = sface_model.alignCrop(frame, face)
-        feature = sface_model.feature(aligned_face)
+def validate_aligned_crop(crop, landmarks, tolerance=Config.RECOGNITION['crop_landmark_tolerance'],
+                          verify_detection=Config.RECOGNITION['crop_verify_detection'],
+                          detection_tolerance=Config.RECOGNITION['crop_detection_tolerance']):
+    """
+    Kiểm tra ảnh do kiosk gửi lên đúng là khuôn mặt đã căn chỉnh kiểu SFace:
+    ảnh màu 112x112x3 uint8, 5 điểm mốc nằm cách điểm chuẩn không quá tolerance pixel và,
+    nếu bật verify_detection, YuNet tìm thấy đúng một khuôn mặt có điểm mốc khớp với điểm mốc gửi lên
+    không quá detection_tolerance pixel (điểm mốc do client tự khai nên không đủ để tin ảnh).
+    Returns:
+        str: Lý do không hợp lệ, hoặc None nếu hợp lệ.
+    """
+    if not isinstance(crop, np.ndarray) or crop.shape != (112, 112, 3) or crop.dtype != np.uint8:
+        return "Aligned crop must be a 112x112 color image (uint8)"
+    try:
+        landmarks = np.asarray(landmarks, dtype=np.float32).reshape(5, 2)
+    except (TypeError, ValueError):
+        return "Landmarks must be 5 (x, y) points"
+    if not np.all(np.isfinite(landmarks)):
+        return "Landmarks must be finite numbers"
+    distances = np.linalg.norm(landmarks - SFACE_REFERENCE_LANDMARKS, axis=1)
+    if distances.max() > tolerance:
+        return f"Landmarks are {distances.max():.1f}px from the aligned positions (max {tolerance})"
+    if not verify_detection:
+        return None
 
-        # Đọc embeddings.pkl
-        with open(Config.PATHS['embeddings'], 'rb') as f:
-            person_ids, person_codes, embeddings = pickle.load(f)
+    # Khuôn mặt căn chỉnh chiếm gần hết ảnh 112x112, thêm viền để YuNet phát hiện ổn định
+    pad = CROP_DETECTION_PADDING
+    faces = get_face_service().detect(cv2.copyMakeBorder(crop, pad, pad, pad, pad, cv2.BORDER_CONSTANT))
+    if len(faces) != 1:
+        return f"Expected one face in the aligned crop, detected {len(faces)}"
+    detected = faces[0][4:14].reshape(5, 2) - pad
+    distances = np.linalg.norm(detected - landmarks, axis=1)
+    if distances.max() > detection_tolerance:
+        return f"Landmarks are {distances.max():.1f}px from the detected face (max {detection_tolerance})"
+    return None
 
-        # So khớp
-        best_score = -1
-        best_idx = -1
+def match_aligned_crop(crop, landmarks, threshold=0.4, min_margin=Config.RECOGNITION['min_margin'], source='crop',
+                       validate=True):
+    """
+    Nhận diện từ khuôn mặt kiosk đã tự phát hiện và căn chỉnh: bỏ qua bước phát hiện trên ảnh đầy đủ,
+    đi thẳng tới trích xuất đặc trưng SFace và so khớp.
+    Args:
+        validate (bool): Kiểm tra ảnh bằng validate_aligned_crop; False nếu người gọi đã kiểm tra.
+    Returns:
+        tuple: (person_id, person_code, score), hoặc None nếu không hợp lệ hoặc không nhận diện được.
+    """
+    try:
+        error = validate_aligned_crop(crop, landmarks) if validate else None
+        if error:
+            logging.warning(f"Rejected aligned crop {source}: {error}")
+            return None
 
-        for idx, emb in enumerate(embeddings):
-            score = cosine_similarity(feature, emb)
-            if score > best_score:
-                best_score = score
-                best_idx = idx
+        match = get_face_service().match_aligned(crop, threshold, min_margin)
+        if match is None:
+            logging.info("No matching face. Gallery is empty")
+            return None
 
-        if best_score >= threshold:
-            logging.info(f"Match found: person_code={person_codes[best_idx]}, score={best_score:.4f}")
-            return person_ids[best_idx], person_codes[best_idx], best_score
+        if match.accepted:
+            logging.info(f"Match found: person_code={match.person_code}, score={match.score:.4f}, margin={match.margin:.4f}")
+            return match.person_id, match.person_code, match.score
         else:
-            logging.info(f"No matching face. Best score: {best_score:.4f}")
+            logging.info(f"No matching face. Best score: {match.score:.4f}, margin: {match.margin:.4f}")
             return None
+    except TimeoutError:
+        # Quá tải: để route trả về 503 thay vì coi như không nhận diện được
+        raise
     except Exception as e:
-        logging.error(f"Error in match_face_embedding: {str(e)}")
+        logging.error(f"Error in match_aligned_crop: {str(e)}")
         return None
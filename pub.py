@@ -2,12 +2,14 @@ import sys
 import cv2
 import os
 import numpy as np
-import pickle
-import zmq
 import time
 from datetime import datetime
 from MySQLConnector import getConnector
 from app.config import Config
+from app.utils.gallery_store import GalleryWatcher
+from app.utils.frame_source import LatestFrameReader
+from app.utils.frame_ring import FrameRingWriter
+from app.utils.frame_publisher import FramePublisher
 import logging
 
 # Thiết lập logging
@@ -28,12 +30,9 @@ else:
     logger.error("No camera ID provided.")
     sys.exit(1)
 
-# Thiết lập ZeroMQ
-context = zmq.Context()
-socket = context.socket(zmq.PUB)
-port = 8000 + int(CAMERA_ID)
-socket.bind(f"tcp://*:{port}")
-logger.info(f"ZeroMQ publisher bound to port {port}")
+# Thiết lập ZeroMQ: JPEG cho người xem từ máy khác, khung hình thô qua shared memory cho process cùng máy
+publisher = FramePublisher(8000 + int(CAMERA_ID)) if Config.CAMERA['remote_stream'] else None
+frame_ring = FrameRingWriter(CAMERA_ID) if Config.CAMERA['shared_frames'] else None
 
 # Đọc thông tin camera
 try:
@@ -63,15 +62,15 @@ else:
 
 # Các thông số cấu hình
 SCORE_THRESH = 0.5
+MIN_MARGIN = Config.RECOGNITION['min_margin']
 IOU_THRESH = 0.5
 SKIP_FRAMES = 1
 EARLY_STOP_THRESHOLD = 0.8
 
-# Đường dẫn đến file embeddings
-input_file = './app/embeddings.pkl'
+# Đường dẫn đến thư mục gallery
+input_file = Config.PATHS['gallery']
 try:
-    with open(input_file, 'rb') as f:
-        person_ids, person_codes, embeddings = pickle.load(f)
+    gallery_watcher = GalleryWatcher(input_file)
     logger.info(f"Loaded embeddings from {input_file}")
 except Exception as e:
     logger.error(f"Error loading embeddings file {input_file}: {str(e)}")
@@ -93,6 +92,7 @@ except Exception as e:
 # Lists to keep track of trackers and bounding boxes
 trackers = []
 bboxes = []
+tracked_codes = []
 next_id = 0
 frame_count = 0
 
@@ -102,13 +102,22 @@ def assign_new_id():
     next_id += 1
     return "NA_" + str(new_id)
 
+def share_raw_frame(frame):
+    """Ghi khung hình thô (chưa vẽ khung/nhãn) vào ring shared memory cho các process cùng máy."""
+    if frame_ring is None:
+        return
+    try:
+        frame_ring.write(frame)
+    except Exception as e:
+        logger.error(f"Error writing frame to shared memory: {str(e)}")
+
 def send_frame(camera_index, frame):
+    if publisher is None:
+        return
     try:
-        topic = "newframe"
-        _, buffer = cv2.imencode('.jpg', frame)
-        socket.send_string(topic, zmq.SNDMORE)
-        socket.send(buffer.tobytes())
-        logger.debug(f"Sent frame via ZeroMQ for camera {camera_index}")
+        # Chỉ mã hoá các mức chất lượng đang có người xem, theo fps tối đa của từng mức
+        if publisher.send(frame):
+            logger.debug(f"Sent frame via ZeroMQ for camera {camera_index}")
     except Exception as e:
         logger.error(f"Error sending frame via ZeroMQ: {str(e)}")
 
@@ -139,14 +148,26 @@ def get_fullname(person_code):
         cursor.close()
         conn.close()
 
+# Thread riêng đọc camera, vòng lặp xử lý luôn lấy khung hình mới nhất
+frame_reader = LatestFrameReader(cap, name=f"camera-{CAMERA_ID}")
+last_stats_time = time.monotonic()
+
 while True:
-    ret, frame = cap.read()
+    ret, frame = frame_reader.read(timeout=5)
     if not ret:
-        logger.error("Failed to read frame from video capture")
-        time.sleep(1)
+        logger.error("No new frame from video capture")
         continue
+
+    if time.monotonic() - last_stats_time >= Config.CAMERA['stats_interval']:
+        last_stats_time = time.monotonic()
+        logger.info(f"Camera {CAMERA_ID} frames: {frame_reader.stats()}")
     
+    # Ring nhận khung hình thô, trước khi vẽ khung và nhãn lên frame
+    share_raw_frame(frame)
+
     frame_count += 1
+    # Gallery được tải lại trong thread nền khi có thay đổi, ở đây chỉ lấy bản mới nhất
+    gallery = gallery_watcher.gallery
     process_full_detection = (frame_count % SKIP_FRAMES == 0)
     h, w, _ = frame.shape
     
@@ -164,13 +185,13 @@ while True:
             # Quy đổi lại kích thước gốc
             bbox = [int(b / scale_factor) for b in bbox]
             current_tracked_boxes.append(bbox)
-            current_tracked_ids.append(person_codes[i])
+            current_tracked_ids.append(tracked_codes[i])
             
             p1 = (int(bbox[0]), int(bbox[1]))
             p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
             cv2.rectangle(frame, p1, p2, (255, 0, 0), 2)
             
-            if str(person_codes[i]).startswith("NA"):
+            if str(tracked_codes[i]).startswith("NA"):
                 font = cv2.FONT_HERSHEY_SIMPLEX
                 font_scale = 0.7
                 color = (255, 0, 0)
@@ -183,7 +204,7 @@ while True:
                 color = (0, 255, 0)
                 thickness = 2
                 text_position = (p1[0], p1[1] - 10)
-                cv2.putText(frame, str(person_codes[i]), text_position, font, font_scale, color, thickness)
+                cv2.putText(frame, str(tracked_codes[i]), text_position, font, font_scale, color, thickness)
     
     # Chỉ chạy phát hiện đầy đủ trên các khung hình được chỉ định
     if process_full_detection:
@@ -227,61 +248,56 @@ while True:
                 feature = sface_model.feature(aligned_face)
                 detected = False
                 
-                max_dist = 0
-                best_idx = -1
+                # Lấy ứng viên tốt nhất trên toàn bộ gallery, từ chối nếu quá sát ứng viên tốt nhì
+                match = gallery.best_match(feature, SCORE_THRESH, MIN_MARGIN)
                 
-                for i in range(len(embeddings)):
-                    dist = sface_model.match(embeddings[i], feature)
-                    if dist > max_dist:
-                        max_dist = dist
-                        best_idx = i
-                    if dist > SCORE_THRESH:
-                        detected = True
-                        p1 = (int(bbox[0]), int(bbox[1]))
-                        p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
-                        save_frame = frame.copy()
-                        cv2.rectangle(save_frame, p1, p2, (255, 0, 0), 2)
-                        d_time = datetime.now()
-                        img_name = f"{CAMERA_ID}_{str(d_time).replace(':', '-').replace(' ', '-')}.jpg"
-                        
-                        # Lưu ảnh vào Config.PATHS['notifications']
-                        notifications_dir = os.path.normpath(Config.PATHS['notifications'])
-                        try:
-                            os.makedirs(notifications_dir, exist_ok=True)
-                            img_path = os.path.join(notifications_dir, img_name)
-                            cv2.imwrite(img_path, save_frame)
-                            logger.info(f"Saved recognition image to {img_path}")
-                        except Exception as e:
-                            logger.error(f"Error saving image to {img_path}: {str(e)}")
-                            continue
-                        
-                        # Lấy fullname từ bảng person
-                        fullname = get_fullname(person_codes[i])
-                        
-                        # Insert vào bảng recognise_history
-                        try:
-                            conn = getConnector()
-                            cursor = conn.cursor()
-                            cursor.execute(
-                                "INSERT INTO recognise_history (personcode, fullname, location, time, image) "
-                                "VALUES (%s, %s, %s, %s, %s)",
-                                (person_codes[i], fullname, camera_location, d_time, img_name)
-                            )
-                            conn.commit()
-                            logger.info(
-                                f"Inserted into recognise_history: personcode={person_codes[i]}, "
-                                f"fullname={fullname}, location={camera_location}, time={d_time}, image={img_name}"
-                            )
-                        except Exception as e:
-                            logger.error(f"Error inserting into recognise_history: {str(e)}")
-                        finally:
-                            cursor.close()
-                            conn.close()
-                        
-                        logger.info(f"Recognized person: ID={person_ids[i]}, code={person_codes[i]}")
-                        new_bboxes.append(bbox)
-                        new_face_ids.append(person_codes[i])
-                        break
+                if match is not None and match.accepted:
+                    i = match.index
+                    detected = True
+                    p1 = (int(bbox[0]), int(bbox[1]))
+                    p2 = (int(bbox[0] + bbox[2]), int(bbox[1] + bbox[3]))
+                    save_frame = frame.copy()
+                    cv2.rectangle(save_frame, p1, p2, (255, 0, 0), 2)
+                    d_time = datetime.now()
+                    img_name = f"{CAMERA_ID}_{str(d_time).replace(':', '-').replace(' ', '-')}.jpg"
+                    
+                    # Lưu ảnh vào Config.PATHS['notifications']
+                    notifications_dir = os.path.normpath(Config.PATHS['notifications'])
+                    # Lỗi lưu ảnh không được bỏ qua khuôn mặt: vẫn theo dõi và ghi lịch sử
+                    img_path = os.path.join(notifications_dir, img_name)
+                    try:
+                        os.makedirs(notifications_dir, exist_ok=True)
+                        cv2.imwrite(img_path, save_frame)
+                        logger.info(f"Saved recognition image to {img_path}")
+                    except Exception as e:
+                        logger.error(f"Error saving image to {img_path}: {str(e)}")
+                    
+                    # Lấy fullname từ bảng person
+                    fullname = get_fullname(gallery.person_codes[i])
+                    
+                    # Insert vào bảng recognise_history
+                    try:
+                        conn = getConnector()
+                        cursor = conn.cursor()
+                        cursor.execute(
+                            "INSERT INTO recognise_history (personcode, fullname, location, time, image) "
+                            "VALUES (%s, %s, %s, %s, %s)",
+                            (gallery.person_codes[i], fullname, camera_location, d_time, img_name)
+                        )
+                        conn.commit()
+                        logger.info(
+                            f"Inserted into recognise_history: personcode={gallery.person_codes[i]}, "
+                            f"fullname={fullname}, location={camera_location}, time={d_time}, image={img_name}"
+                        )
+                    except Exception as e:
+                        logger.error(f"Error inserting into recognise_history: {str(e)}")
+                    finally:
+                        cursor.close()
+                        conn.close()
+                    
+                    logger.info(f"Recognized person: ID={gallery.person_ids[i]}, code={gallery.person_codes[i]}")
+                    new_bboxes.append(bbox)
+                    new_face_ids.append(gallery.person_codes[i])
                 
                 if not detected:
                     new_bboxes.append(bbox)
@@ -299,14 +315,14 @@ while True:
                     
                     # Lưu ảnh vào Config.PATHS['notifications']
                     notifications_dir = os.path.normpath(Config.PATHS['notifications'])
+                    # Lỗi lưu ảnh không được bỏ qua khuôn mặt: vẫn theo dõi và ghi lịch sử
+                    img_path = os.path.join(notifications_dir, img_name)
                     try:
                         os.makedirs(notifications_dir, exist_ok=True)
-                        img_path = os.path.join(notifications_dir, img_name)
                         cv2.imwrite(img_path, save_frame)
                         logger.info(f"Saved NA image to {img_path}")
                     except Exception as e:
                         logger.error(f"Error saving NA image to {img_path}: {str(e)}")
-                        continue
                     
                     # Insert vào bảng recognise_history cho người lạ
                     try:
@@ -331,38 +347,33 @@ while True:
         # Khởi tạo lại trackers
         trackers = []
         bboxes = []
-        person_codes = []
+        tracked_codes = []
         
         for i, bbox in enumerate(old_bboxes):
             tracker = cv2.TrackerKCF_create()
             tracker.init(frame_resized, tuple([int(b * scale_factor) for b in bbox]))
             trackers.append(tracker)
             bboxes.append(bbox)
-            person_codes.append(old_face_ids[i])
+            tracked_codes.append(old_face_ids[i])
         
         for i, bbox in enumerate(new_bboxes):
             tracker = cv2.TrackerKCF_create()
             tracker.init(frame_resized, tuple([int(b * scale_factor) for b in bbox]))
             trackers.append(tracker)
             bboxes.append(bbox)
-            person_codes.append(new_face_ids[i])
+            tracked_codes.append(new_face_ids[i])
     
     # Gửi và hiển thị khung hình qua ZeroMQ
     send_frame(CAMERA_ID, frame)
     
-    # Tải lại embeddings mỗi 10 giây
-    if datetime.now().second % 10 == 0:
-        try:
-            with open(input_file, 'rb') as f:
-                person_ids, person_codes, embeddings = pickle.load(f)
-            logger.info(f"Reloaded embeddings from {input_file}")
-        except Exception as e:
-            logger.error(f"Error reloading embeddings file {input_file}: {str(e)}")
-    
     cv2.imshow('Face Detection and Tracking', frame)
     
     if cv2.waitKey(1) & 0xFF == 27:
         break
 
-cap.release()
+frame_reader.stop()
+if frame_ring is not None:
+    frame_ring.close()
+if publisher is not None:
+    publisher.close()
 cv2.destroyAllWindows()
\ No newline at end of file
@@ -1,6 +1,13 @@
+import os
 from app import create_app
+from app.services.stream_gateway import start_websocket_server
 
 app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    debug = True
+    # WebSocket xem camera trực tiếp, dùng chung subscription camera với route MJPEG.
+    # Với debug reloader, process cha chỉ theo dõi file; server chạy trong process con (WERKZEUG_RUN_MAIN)
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_websocket_server(app)
+    app.run(debug=debug, host='0.0.0.0', port=5000)